@@ -1,10 +1,26 @@
-from flask import Flask, send_file, render_template, request
-from jsonschema import validate, ValidationError
+from flask import Flask, Response, render_template, request
+from jsonschema.validators import validator_for
 from flask_cors import CORS
 import json
+import base64
+import hashlib
 from enum import Enum
 import os
 import uuid 
+import math
+import itertools
+import queue
+import menu_cache
+import menu_storage
+import menu_sqlite
+import menu_shards
+import menu_shared
+import menu_index
+import menu_payload
+import menu_json
+import menu_query
+import menu_results
+import menu_events
 
 app = Flask(__name__)
 
@@ -14,7 +30,7 @@ PORT = int(os.getenv('PORT', '8080'))
 # The url with port 5000 is there so that the customer feedback system can access the data.
 # If there is a better way to do this, please let me know.
 
-CORS(app, origins=[f'http://{HOST}:{PORT}', f'http://localhost:{PORT}', f'http://127.0.0.1:{PORT}', 'http://127.0.0.1:5000', 'http://localhost:5000'])
+CORS(app, origins=[f'http://{HOST}:{PORT}', f'http://localhost:{PORT}', f'http://127.0.0.1:{PORT}', 'http://127.0.0.1:5000', 'http://localhost:5000'], expose_headers=['X-Next-Cursor', 'X-Menu-Version', 'X-Cache'])
 
 class SearchArea(Enum):
     RESTAURANTS = 'restaurants'
@@ -29,6 +45,121 @@ def get_menu_file():
     else:
         raise FileNotFoundError(f'The menu file {MENU_FILE} does not exist')
 
+def get_storage():
+    storage_type = app.config.get('MENU_STORAGE', os.getenv('MENU_STORAGE', 'json'))
+    options = {'changes_kept': int(app.config.get('MENU_CHANGES_KEPT', os.getenv('MENU_CHANGES_KEPT', '1000')))}
+    if storage_type in ['json', 'journal']:
+        options['warm_start'] = str(app.config.get('MENU_WARM_START', os.getenv('MENU_WARM_START', 'false'))).lower() == 'true'
+    if storage_type == 'journal':
+        options['compact_after'] = int(app.config.get('MENU_JOURNAL_COMPACT_AFTER', os.getenv('MENU_JOURNAL_COMPACT_AFTER', '100')))
+    if storage_type == 'sqlite':
+        options['database'] = app.config.get('MENU_DATABASE', os.getenv('MENU_DATABASE'))
+    if storage_type == 'sharded':
+        options['directory'] = app.config.get('MENU_SHARDS_DIR', os.getenv('MENU_SHARDS_DIR'))
+    if storage_type == 'shared':
+        options['directory'] = app.config.get('MENU_SHARED_DIR', os.getenv('MENU_SHARED_DIR'))
+    return menu_storage.get_storage(storage_type, get_menu_file(), **options)
+
+def get_menu_snapshot():
+    return get_storage().snapshot()
+
+def search_names(snapshot, search_area, search_name):
+    results = []
+    for indexes in snapshot.derived_parts('names', menu_index.build_name_indexes):
+        results.extend(indexes[search_area].search(search_name))
+    return results
+
+def search_contains(snapshot, search_area, search_value):
+    results = []
+    for index in snapshot.derived_parts('contains', menu_index.build_contains_index):
+        results.extend(index.search(search_area, search_value))
+    return results
+
+def search_fuzzy(snapshot, search_area, search_name):
+    # Best score first across every part of the menu, ties in menu order
+    scored = []
+    for part, indexes in enumerate(snapshot.derived_parts('fuzzy', menu_index.build_fuzzy_indexes)):
+        for position, (score, node) in enumerate(indexes[search_area].scored(search_name)):
+            scored.append((-score, part, position, node))
+    scored.sort(key=lambda entry: entry[:3])
+    return [node for score, part, position, node in scored]
+
+def get_id_index(snapshot):
+    return snapshot.derived('ids', menu_index.build_id_index)
+
+def get_query_parts(snapshot):
+    return list(zip(snapshot.derived_parts('names', menu_index.build_name_indexes),
+                    snapshot.derived_parts('facets', menu_index.build_facet_index),
+                    snapshot.derived_parts('ancestors', menu_index.build_ancestor_index),
+                    snapshot.derived_parts('prices', menu_index.build_price_index)))
+
+def get_price_range(message):
+    # min_price and max_price as numbers, or the error response for a bad one
+    prices = {}
+    for parameter in ['min_price', 'max_price']:
+        value = request.args.get(parameter)
+        if value is not None:
+            try:
+                prices[parameter] = float(value)
+            except ValueError:
+                return None, (f'{message} ({parameter})', 400)
+            if math.isnan(prices[parameter]):
+                return None, (f'{message} ({parameter})', 400)
+    return prices, None
+
+def get_known_fields(snapshot):
+    return snapshot.cached('known_fields', lambda: set().union(*snapshot.derived_parts('field_names', menu_index.build_field_names)))
+
+def get_fields(snapshot):
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+
+    # Fields that no node has are dropped, so they do not make a separate
+    # cached view of the same menu
+    known_fields = get_known_fields(snapshot)
+    return tuple(sorted({field.strip() for field in fields.split(',') if field.strip() in known_fields}))
+
+def get_restaurant_scope(snapshot, restaurant):
+    # Only names that exist are cached, so made up ones cannot grow the cache
+    restaurants = snapshot.restaurants_named(restaurant)
+    if not restaurants:
+        return None
+    return snapshot.cached(('scope', restaurant), lambda: menu_index.restaurant_scope(restaurants))
+
+def project_nodes(snapshot, nodes, fields):
+    if fields is None:
+        return nodes
+    # The memo only lives for this call: the menu views built from it are
+    # cached (and bounded) by get_menu_payload instead
+    memo = {}
+    return [menu_index.project(node, fields, memo) for node in nodes]
+
+def build_menu_view(snapshot, fields, restaurant):
+    if restaurant is None:
+        restaurants = snapshot.data.get(SearchArea.RESTAURANTS.value, [])
+    else:
+        restaurants = snapshot.restaurants_named(restaurant)
+    return dict(snapshot.menu_root(), restaurants=project_nodes(snapshot, restaurants, fields))
+
+def get_menu_payload(snapshot, fields=None, restaurant=None):
+    if fields is None and restaurant is None:
+        return snapshot.derived('payload', menu_payload.build_payload)
+
+    # Every subset of fields (and every restaurant) makes its own view, so
+    # only the recently used ones are kept
+    views = get_view_cache(snapshot)
+    payload = views.get((fields, restaurant))
+    if payload is None:
+        payload = menu_payload.build_payload(build_menu_view(snapshot, fields, restaurant))
+        # Twice the body leaves room for the compressed copies, which are smaller
+        views.put((fields, restaurant), payload, 2 * len(payload.body))
+    return payload
+
+def get_view_cache(snapshot):
+    max_bytes = int(app.config.get('MENU_VIEW_CACHE_BYTES', os.getenv('MENU_VIEW_CACHE_BYTES', str(16 * 1024 * 1024))))
+    return snapshot.cached(('views', max_bytes), lambda: menu_results.SizedCache(max_bytes))
+
 @app.route('/')
 def home():
     return render_template('customer_view.html')
@@ -39,157 +170,408 @@ def admin_view():
 
 @app.route('/api/get_data')
 def get_all_data():
-    return send_file(get_menu_file(), mimetype='application/json')
+    snapshot = get_menu_snapshot()
+    fields = get_fields(snapshot)
+
+    restaurant = request.args.get('restaurant')
+    if restaurant is not None and not snapshot.restaurants_named(restaurant):
+        return 'Restaurant not found', 404
+
+    payload = get_menu_payload(snapshot, fields, restaurant)
+    encoding = payload.negotiate(request.accept_encodings)
+
+    # The client already has this version of the menu (in any encoding)
+    if any(request.if_none_match.contains(etag) for etag in payload.etags()):
+        response = Response(status=304)
+    else:
+        response = Response(payload.encoded(encoding), mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(payload.variant_etag(encoding))
+    response.headers['X-Menu-Version'] = str(snapshot.version)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/get_data/node')
+def get_node():
+    return cached_results(run_node)
+
+def parse_node_path(path):
+    # restaurants/0/menus/1 -> ['restaurants', 0, 'menus', 1]
+    return [int(key) if key.isdigit() else key for key in path.split('/') if key]
+
+def run_node(snapshot):
+    path = parse_node_path(request.args.get('path', ''))
+
+    depth = request.args.get('depth')
+    if depth is not None and not depth.isdigit():
+        return 'Invalid node parameter (depth)', 400
+
+    counts = request.args.get('counts')
+    if counts is not None and counts not in ['true', 'false']:
+        return 'Invalid node parameter (counts)', 400
+
+    # A single restaurant is read on its own, so sharded storage does not
+    # load the others
+    if len(path) >= 2 and path[0] == SearchArea.RESTAURANTS.value and isinstance(path[1], int):
+        node = menu_index.find_node(snapshot.restaurant_at(path[1]), path[2:])
+    else:
+        node = menu_index.find_node(snapshot.data, path)
+    if node is None:
+        return 'Node not found', 404
+
+    node = menu_index.subtree(node, int(depth) if depth is not None else None, counts == 'true')
+    return Response(menu_json.dumps(node), mimetype='application/json', headers={'X-Menu-Version': str(snapshot.version)})
+
+@app.route('/api/get_data/changes')
+def get_changes():
+    since = request.args.get('since')
+    if since is None or not since.isdigit():
+        return 'Invalid since parameter', 400
+
+    version, changes = get_storage().changes_since(int(since))
+    if changes is None:
+        return Response(menu_json.dumps({'version': version, 'resync': True}), mimetype='application/json')
+
+    changes = [format_change(change) for change in changes]
+    return Response(menu_json.dumps({'version': version, 'changes': changes}), mimetype='application/json')
+
+def format_change(change):
+    return {'version': change['version'], 'op': change['op'], 'path': change['path'], 'newData': change.get('value')}
+
+@app.route('/api/get_data/events')
+def get_events():
+    storage = get_storage()
+    broker = menu_events.get_broker(storage, int(app.config.get('MENU_EVENTS_QUEUE_SIZE', os.getenv('MENU_EVENTS_QUEUE_SIZE', '100'))))
+    keepalive = float(app.config.get('MENU_EVENTS_KEEPALIVE', os.getenv('MENU_EVENTS_KEEPALIVE', '15')))
+
+    # Subscribe before looking at the current version so no change is missed
+    subscriber = broker.subscribe()
+    version = storage.snapshot().version
+
+    # A reconnecting EventSource sends the id of the last event it received
+    backlog = []
+    last_event_id = request.headers.get('Last-Event-ID', '')
+    if last_event_id.isdigit():
+        version, backlog = storage.changes_since(int(last_event_id))
+
+    def stream():
+        last_version = version
+        try:
+            if backlog is None:
+                yield menu_events.format_event('resync', json.dumps({'version': version}), version)
+                return
+
+            yield menu_events.format_event('ready', json.dumps({'version': version}), version)
+            for change in backlog:
+                yield menu_events.format_event('change', json.dumps(format_change(change)), change['version'])
+
+            while True:
+                if subscriber.dropped:
+                    yield menu_events.format_event('resync', json.dumps({'version': last_version}))
+                    return
+
+                try:
+                    change = subscriber.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    # Picks up changes written to the journal by other workers
+                    storage.snapshot()
+                    yield ': keep-alive\n\n'
+                    continue
+
+                if change['version'] <= last_version:
+                    continue
+                if change.get('resync'):
+                    yield menu_events.format_event('resync', json.dumps({'version': change['version']}), change['version'])
+                    return
+
+                last_version = change['version']
+                yield menu_events.format_event('change', json.dumps(format_change(change)), last_version)
+        finally:
+            broker.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/get_data/search', methods=['GET'])
 def search_data():
+    return cached_results(run_search)
+
+def run_search(snapshot):
     search_area = request.args.get('area')
     search_option = request.args.get('option')
     search_name = request.args.get('name')
     search_id = request.args.get('id')
     search_reward_eligible = request.args.get('reward_eligible')
     search_dietary_requirements = request.args.get('dietary_requirements')
+    search_sort = request.args.get('sort')
+
+    prices, error = get_price_range('Invalid search parameter')
+    if error:
+        return error
+    if search_sort is not None and search_sort != 'price':
+        return 'Invalid search parameter (sort)', 400
 
-    with open(get_menu_file(), 'r') as f:
-        data = json.load(f)
-    
     if search_area and (search_name or (search_option and search_name)) and not search_reward_eligible:
     
-        if search_area == SearchArea.RESTAURANTS.value:
-            result = []
-            if search_option == 'name':
-                result = [restaurant for restaurant in data[SearchArea.RESTAURANTS.value] if (search_name.lower() in restaurant['name'].lower() or search_name == '*')]
-            elif search_option == 'contains':
-                result = contains_value(data[SearchArea.RESTAURANTS.value], search_name)
-            else:
-                return 'Invalid search parameter (option)', 400
-
-        elif search_area == SearchArea.MENUS.value:
-            result = []
-            if search_option == 'name':
-                for restaurant in data[SearchArea.RESTAURANTS.value]:
-                    for menu in restaurant[SearchArea.MENUS.value]:
-                        if search_name.lower() in menu['name'].lower() or search_name == '*':
-                            result.append(menu)
-            elif search_option == 'contains':
-                for restaurant in data[SearchArea.RESTAURANTS.value]:
-                    for menu in restaurant[SearchArea.MENUS.value]:
-                        if contains_value(menu, search_name):
-                            result.append(menu)
-            else:
-                return 'Invalid search parameter (option)', 400
-        
-        elif search_area == SearchArea.CATEGORIES.value:
-            result = []
-            if search_option == 'name':
-                for restaurant in data[SearchArea.RESTAURANTS.value]:
-                    for menu in restaurant[SearchArea.MENUS.value]:
-                        for category in menu[SearchArea.CATEGORIES.value]:
-                            if search_name.lower() in category['name'].lower() or search_name == '*':
-                                result.append(category)
-            elif search_option == 'contains':
-                for restaurant in data[SearchArea.RESTAURANTS.value]:
-                    for menu in restaurant[SearchArea.MENUS.value]:
-                        for category in menu[SearchArea.CATEGORIES.value]:
-                            if contains_value(category, search_name):
-                                result.append(category)
-            else:
-                return 'Invalid search parameter (option)', 400
-                
-        elif search_area == SearchArea.ITEMS.value:
-            result = []
-            if search_option == 'name':
-                for restaurant in data[SearchArea.RESTAURANTS.value]:
-                    for menu in restaurant[SearchArea.MENUS.value]:
-                        for category in menu[SearchArea.CATEGORIES.value]:
-                            for item in category[SearchArea.ITEMS.value]:
-                                if search_name.lower() in item['name'].lower() or search_name == '*':
-                                    result.append(item)
-            elif search_option == 'contains':
-                for restaurant in data[SearchArea.RESTAURANTS.value]:
-                    for menu in restaurant[SearchArea.MENUS.value]:
-                        for category in menu[SearchArea.CATEGORIES.value]:
-                            for item in category[SearchArea.ITEMS.value]:
-                                if contains_value(item, search_name):
-                                    result.append(item)
-            else:
-                return 'Invalid search parameter (option)', 400
-                        
-        else:
+        if search_area not in [area.value for area in SearchArea]:
             return 'Invalid search parameter (area)', 400
 
-    elif search_reward_eligible and not(search_area or search_option or search_name or search_dietary_requirements or search_id):
-            result = []
-            for restaurant in data[SearchArea.RESTAURANTS.value]:
-                for menu in restaurant[SearchArea.MENUS.value]:
-                    for category in menu[SearchArea.CATEGORIES.value]:
-                        for item in category[SearchArea.ITEMS.value]:
-                            
-                            if search_reward_eligible == 'true':
-                                if item['rewardEligible'] == True:
-                                    result.append(item)
-                            elif search_reward_eligible == 'false':
-                                if item['rewardEligible'] == False:
-                                    result.append(item)
-                            else:
-                                return 'Invalid search parameter (reward_eligible)', 400
-    
-    elif search_dietary_requirements and not(search_area or search_option or search_name or search_reward_eligible or search_id):
-            result = []
-            for restaurant in data[SearchArea.RESTAURANTS.value]:
-                for menu in restaurant[SearchArea.MENUS.value]:
-                    for category in menu[SearchArea.CATEGORIES.value]:
-                        for item in category[SearchArea.ITEMS.value]:
-                            if search_dietary_requirements in item['dietary'] or (search_dietary_requirements == '*' and item['dietary'] != []):
-                                result.append(item)
-
-    elif search_id and not(search_area or search_option or search_name or search_reward_eligible or search_dietary_requirements):
-        result = []
-        for restaurant in data[SearchArea.RESTAURANTS.value]:
-            for menu in restaurant[SearchArea.MENUS.value]:
-                for category in menu[SearchArea.CATEGORIES.value]:
-                    for item in category[SearchArea.ITEMS.value]:
-                        if item['id'] == search_id or search_id == '*':
-                            result.append(item)
+        if search_option == 'name':
+            result = search_names(snapshot, search_area, search_name)
+        elif search_option == 'contains':
+            result = search_contains(snapshot, search_area, search_name)
+        elif search_option == 'fuzzy':
+            result = search_fuzzy(snapshot, search_area, search_name)
+        else:
+            return 'Invalid search parameter (option)', 400
+
+        if prices or search_sort:
+            if search_area != SearchArea.ITEMS.value:
+                return 'Invalid search parameter (area)', 400
+            result = [item for item in result if menu_query.price_in_range(item, **prices)] if prices else result
+            result = menu_query.sort_by_price(result) if search_sort else result
+
+    elif (search_reward_eligible or search_dietary_requirements or prices) and not(search_area or search_option or search_name or search_id):
+        if search_reward_eligible and search_reward_eligible not in ['true', 'false']:
+            return 'Invalid search parameter (reward_eligible)', 400
+
+        reward = search_reward_eligible == 'true' if search_reward_eligible else None
+        result = menu_query.run_query(get_query_parts(snapshot), SearchArea.ITEMS.value,
+                                      dietary=request.args.getlist('dietary_requirements'), reward=reward,
+                                      sort=search_sort, **prices)
+
+    elif search_id and not(search_area or search_option or search_name or search_reward_eligible or search_dietary_requirements or prices):
+        if search_id == '*' and search_sort:
+            result = menu_query.run_query(get_query_parts(snapshot), SearchArea.ITEMS.value, sort=search_sort)
+        elif search_id == '*':
+            result = search_names(snapshot, SearchArea.ITEMS.value, '*')
+        else:
+            result = [item for item, path in get_id_index(snapshot).get(search_id, [])]
 
     else:
         return 'Invalid search parameters', 400
 
+    return search_results(snapshot, result)
+
+@app.route('/api/get_data/query')
+def query_data():
+    return cached_results(run_query)
+
+def run_query(snapshot):
+    area = request.args.get('area', SearchArea.ITEMS.value)
+    if area not in [search_area.value for search_area in SearchArea]:
+        return 'Invalid query parameter (area)', 400
+
+    reward = request.args.get('reward_eligible')
+    if reward is not None and reward not in ['true', 'false']:
+        return 'Invalid query parameter (reward_eligible)', 400
+
+    prices, error = get_price_range('Invalid query parameter')
+    if error:
+        return error
+
+    sort = request.args.get('sort')
+    if sort is not None and (sort != 'price' or area != SearchArea.ITEMS.value):
+        return 'Invalid query parameter (sort)', 400
+
+    result = menu_query.run_query(get_query_parts(snapshot), area,
+                                  name=request.args.get('name'),
+                                  dietary=request.args.getlist('dietary_requirements'),
+                                  reward=reward == 'true' if reward is not None else None,
+                                  sort=sort, **prices)
+    return search_results(snapshot, result)
+
+def get_result_cache(storage):
+    max_bytes = int(app.config.get('MENU_SEARCH_CACHE_BYTES', os.getenv('MENU_SEARCH_CACHE_BYTES', str(16 * 1024 * 1024))))
+    if max_bytes <= 0:
+        return None
+    return menu_results.get_cache(storage, max_bytes)
+
+def cached_results(search):
+    storage = get_storage()
+    snapshot = storage.snapshot()
+    cache = get_result_cache(storage)
+    if cache is None:
+        return search(snapshot)
+
+    # The order of repeated parameters (dietary_requirements) does not change the results
+    params = tuple(sorted((name, tuple(sorted(values))) for name, values in request.args.lists()))
+    key = (request.path, snapshot.signature, snapshot.version, params)
+
+    entry = cache.get(key)
+    if entry is None:
+        response = app.make_response(search(snapshot))
+        # Invalid parameters are cheap to reject again, and cursors expire
+        if response.status_code not in [200, 404]:
+            return response
+        body = read_body(response, cache.max_entry_bytes)
+        if body is None:
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        headers = {name: response.headers[name] for name in ['Content-Type', 'X-Next-Cursor', 'X-Menu-Version'] if name in response.headers}
+        entry = (body, response.status_code, headers)
+        cache.put(key, *entry)
+        state = 'MISS'
+    else:
+        state = 'HIT'
+
+    body, status, headers = entry
+    return Response(body, status=status, headers=dict(headers, **{'X-Cache': state}))
+
+def read_body(response, max_bytes):
+    # The body of a response no longer than max_bytes. A longer one is left
+    # streaming, with the part already read put back in front of the rest.
+    chunks = []
+    size = 0
+    body = response.iter_encoded()
+    for chunk in body:
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_bytes:
+            response.response = itertools.chain(chunks, body)
+            return None
+    return b''.join(chunks)
+
+@app.route('/api/get_data/search/cache')
+def search_cache_stats():
+    cache = get_result_cache(get_storage())
+    stats = cache.stats() if cache is not None else {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0, 'max_bytes': 0}
+    return Response(menu_json.dumps(stats), mimetype='application/json')
+
+def search_results(snapshot, result):
+    fields = get_fields(snapshot)
+
+    restaurant = request.args.get('restaurant')
+    if restaurant is not None:
+        scope = get_restaurant_scope(snapshot, restaurant)
+        result = [node for node in result if id(node) in scope] if scope is not None else []
+
     if not result:
         return 'No results found', 404
 
-    return json.dumps(result)
+    return paginate_results(result, snapshot, fields)
 
-def contains_value(data, search_value):
-        if isinstance(data, dict):
-            return any(contains_value(value, search_value) for value in data.values())
-        elif isinstance(data, list):
-            return any(contains_value(item, search_value) for item in data)
-        else:
-            return data == search_value
+def snapshot_tag(snapshot):
+    # The file signature identifies the menu version across worker processes
+    return hashlib.sha1(repr(snapshot.signature).encode('utf-8')).hexdigest()[:16]
 
-def update_data_in_json(path, new_data):
+def encode_cursor(offset, snapshot):
+    token = json.dumps([offset, snapshot_tag(snapshot)]).encode('utf-8')
+    return base64.urlsafe_b64encode(token).decode('ascii')
+
+def decode_cursor(cursor, snapshot):
     try:
-        with open(get_menu_file(), 'r') as f:
-            old_data = json.load(f)
-        
-        target = old_data
-        for key in path[:-1]:
-            target = target[key]
-
-        if path[-2] == SearchArea.ITEMS.value:
-            target[path[-1]]['name'] = new_data['name']
-            target[path[-1]]['price'] = float(new_data['price'])
-            target[path[-1]]['rewardEligible'] = new_data['rewardEligible']
+        offset, tag = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        return None, ('Invalid search parameter (cursor)', 400)
+    if not isinstance(offset, int) or offset < 0:
+        return None, ('Invalid search parameter (cursor)', 400)
+    if tag != snapshot_tag(snapshot):
+        return None, ('Cursor expired (the menu has changed)', 409)
+    return offset, None
+
+def stream_json_array(values, chunk_size=64):
+    yield b'['
+    for start in range(0, len(values), chunk_size):
+        chunk = b','.join(menu_json.dumps(value) for value in values[start:start + chunk_size])
+        yield chunk if start == 0 else b',' + chunk
+    yield b']'
+
+def paginate_results(result, snapshot, fields=None):
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor')
+    headers = {}
+
+    offset = 0
+    if cursor:
+        offset, error = decode_cursor(cursor, snapshot)
+        if error:
+            return error
+
+    if limit is not None:
+        if not limit.isdigit() or int(limit) < 1:
+            return 'Invalid search parameter (limit)', 400
+        end = offset + int(limit)
+        if end < len(result):
+            headers['X-Next-Cursor'] = encode_cursor(end, snapshot)
+        result = result[offset:end]
+    elif offset:
+        result = result[offset:]
+
+    return Response(stream_json_array(project_nodes(snapshot, result, fields)), mimetype='application/json', headers=headers)
+
+@app.route('/api/get_data/items', methods=['POST'])
+def get_items_by_id():
+    data = request.json
+    ids = data.get('ids') if isinstance(data, dict) else None
+
+    if not isinstance(ids, list) or not all(isinstance(item_id, str) for item_id in ids):
+        return 'Invalid ids parameter', 400
+
+    id_index = get_id_index(get_menu_snapshot())
+    items = {}
+    missing = []
+    for item_id in ids:
+        matches = id_index.get(item_id)
+        if matches:
+            item, path = matches[0]
+            items[item_id] = {'item': item, 'path': path}
+        else:
+            missing.append(item_id)
+
+    return Response(menu_json.dumps({'items': items, 'missing': missing}), mimetype='application/json')
+
+def parse_if_match():
+    # If-Match holds the X-Menu-Version a change was based on, or the ETag
+    # /api/get_data sent with the whole menu. The change is only applied
+    # while the menu is still at that version.
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None, None
+
+    versions = set()
+    for tag in if_match.as_set(include_weak=True):
+        if tag.isdigit():
+            versions.add(int(tag))
+        elif menu_payload.is_etag(tag):
+            # The ETag of an older menu matches no version, so the change is refused
+            snapshot = get_menu_snapshot()
+            if tag in get_menu_payload(snapshot).etags():
+                versions.add(snapshot.version)
         else:
-            target[path[-1]] = new_data
+            return None, ('Invalid If-Match header', 400)
+    return versions, None
 
-        with open(get_menu_file(), 'w') as f:
-            json.dump(old_data, f)
+def commit_operations(operations, message, error_message):
+    if_version, error = parse_if_match()
+    if error:
+        return error
 
-        return 'Data updated', 200
+    try:
+        snapshot = get_storage().commit(operations, if_version)
+        return message, 200, {'X-Menu-Version': str(snapshot.version)}
+    except menu_storage.VersionConflict as e:
+        return 'The menu has changed, reload it and try again', 409, {'X-Menu-Version': str(e.version)}
     except Exception as e:
-        return f'Error updating data: {str(e)}', 400
+        return f'{error_message}: {str(e)}', 400
+
+def update_data_in_json(path, new_data):
+    return commit_operations([{'op': 'update', 'path': path, 'value': new_data}], 'Data updated', 'Error updating data')
+
+def check_update_parameters(path, new_data):
+    if not path or len(path) < 2 or new_data is None:
+        return 'Invalid update parameters'
+    elif not isinstance(path[0], str):
+        return 'Invalid path structure (path does not start with string value)'
+    elif (path[-2] not in [SearchArea.ITEMS.value, 'dietary'] and path[-1] != 'name'):
+        return 'Invalid path structure (last element is not name)'
+    elif (path[-2] in [SearchArea.ITEMS.value, 'dietary'] and not isinstance(path[-1], int)):
+        return 'Invalid path structure (last element is not int)'
+    elif not menu_json.numbers_fit(new_data):
+        return 'Invalid update parameters (numbers must be finite and fit in 64 bits)'
+    return None
 
 @app.route('/api/update_data', methods=['PUT'])
 def update_data():
@@ -197,33 +579,33 @@ def update_data():
     path = data['path']
     new_data = data['newData']
 
-    if not path or new_data is None:
-        return 'Invalid update parameters', 400
-    elif not isinstance(path[0], str):
-        return 'Invalid path structure (path does not start with string value)', 400
-    elif (path[-2] not in [SearchArea.ITEMS.value, 'dietary'] and path[-1] != 'name'):
-        return 'Invalid path structure (last element is not name)', 400
-    elif (path[-2] in [SearchArea.ITEMS.value, 'dietary'] and not isinstance(path[-1], int)):
-        return 'Invalid path structure (last element is not int)', 400
+    error = check_update_parameters(path, new_data)
+    if error:
+        return error, 400
 
     return update_data_in_json(path, new_data)
 
 def add_data_to_json(path, new_data):
-    try:
-        with open(get_menu_file(), 'r') as f:
-            old_data = json.load(f)
-        
-        target = old_data
-        for key in path:
-            target = target[key]
-        target.append(new_data)
-
-        with open(get_menu_file(), 'w') as f:
-            json.dump(old_data, f)
-
-        return 'Data added', 200
-    except Exception as e:
-        return f'Error adding data: {str(e)}', 400
+    return commit_operations([{'op': 'add', 'path': path, 'value': new_data}], 'Data added', 'Error adding data')
+
+def prepare_add_parameters(path, new_data):
+    if not path or new_data is None:
+        return 'Invalid add parameters'
+
+    if not menu_json.numbers_fit(new_data):
+        return 'Invalid add parameters (numbers must be finite and fit in 64 bits)'
+
+    if path[-1] == SearchArea.ITEMS.value and isinstance(new_data, dict):
+        new_data['id'] = str(uuid.uuid4())
+
+    if not isinstance(path[-1], str) or not isinstance(path[0], str) or check_new_data_schema(new_data, path) == False:
+        return 'Invalid add parameters'
+
+    if isinstance(new_data, dict) and 'price' in new_data:
+        new_data['price'] = float(new_data['price'])
+        if not math.isfinite(new_data['price']):
+            return 'Invalid add parameters (numbers must be finite and fit in 64 bits)'
+    return None
 
 @app.route('/api/add_data', methods=['POST'])
 def add_data():
@@ -231,58 +613,95 @@ def add_data():
     path = data['path']
     new_data = data['newData']
 
-    if path[-1] == SearchArea.ITEMS.value:
-        new_data['id'] = str(uuid.uuid4())
-
-    if not path or new_data is None or not isinstance(path[-1], str) or not isinstance(path[0], str) or check_new_data_schema(new_data, path) == False:
-        return 'Invalid add parameters', 400
-
-    if 'price' in new_data:
-        new_data['price'] = float(new_data['price'])
+    error = prepare_add_parameters(path, new_data)
+    if error:
+        return error, 400
 
     return add_data_to_json(path, new_data)
 
 def delete_data_from_json(path):
-    try:
-        with open(get_menu_file(), 'r') as f:
-            old_data = json.load(f)
-        
-        target = old_data
-        for key in path[:-1]:
-            target = target[key]
-        del target[path[-1]]
-
-        with open(get_menu_file(), 'w') as f:
-            json.dump(old_data, f)
-
-        return 'Data deleted', 200
-    except Exception as e:
-        return f'Error deleting data: {str(e)}', 400
+    return commit_operations([{'op': 'delete', 'path': path}], 'Data deleted', 'Error deleting data')
+
+def check_delete_parameters(path):
+    if not path or not isinstance(path[-1], int) or not isinstance(path[0], str):
+        return 'Invalid delete parameters'
+    return None
 
 @app.route('/api/delete_data', methods=['DELETE'])
 def delete_data():
     data = request.json
     path = data['path']
 
-    if not path or not isinstance(path[-1], int) or not isinstance(path[0], str):
-        return 'Invalid delete parameters', 400
+    error = check_delete_parameters(path)
+    if error:
+        return error, 400
 
     return delete_data_from_json(path)
 
+@app.route('/api/batch', methods=['POST'])
+def batch_data():
+    data = request.json
+    requested = data.get('operations') if isinstance(data, dict) else None
+
+    if not isinstance(requested, list) or not requested:
+        return 'Invalid batch parameters', 400
+
+    # Every operation is checked before anything is applied, and they are then
+    # applied together and saved once, so either all of them happen or none do
+    operations = []
+    for index, entry in enumerate(requested):
+        op = entry.get('op') if isinstance(entry, dict) else None
+        path = entry.get('path') if isinstance(entry, dict) else None
+        new_data = entry.get('newData') if isinstance(entry, dict) else None
+
+        if not isinstance(path, list):
+            error = 'Invalid path'
+        elif op == 'update':
+            error = check_update_parameters(path, new_data)
+        elif op == 'add':
+            error = prepare_add_parameters(path, new_data)
+        elif op == 'delete':
+            error = check_delete_parameters(path)
+        else:
+            error = 'Invalid operation (op must be add, update or delete)'
+
+        if error:
+            return f'Operation {index}: {error}', 400
+
+        operations.append({'op': op, 'path': path, 'value': new_data} if op != 'delete' else {'op': op, 'path': path})
+
+    return commit_operations(operations, 'Batch applied', 'Error applying batch')
+
 def check_new_data_schema(new_data, path):
     target = path[-1]
-    schema = get_schema(target)
-        
-    try:
-        validate(instance=new_data, schema=schema)
-        return True
-    except ValidationError as e:
-        return False
-    
-def get_schema(target):
-    with open('/src/new_data_schema.json', 'r') as f:
-        schema = json.load(f).get(target, {})
-    return schema
+    return get_validator(target).is_valid(new_data)
+
+def get_schema_file():
+    return app.config.get('SCHEMA_FILE', os.path.join(os.path.dirname(__file__), 'new_data_schema.json'))
+
+# Schema file path -> (file signature, parsed schemas, compiled validators by target)
+_schema_cache = {}
+
+def get_schemas():
+    schema_file = get_schema_file()
+    signature = menu_cache.file_signature(schema_file)
+    cached = _schema_cache.get(schema_file)
+    if cached is None or cached[0] != signature:
+        with open(schema_file, 'r') as f:
+            cached = (signature, json.load(f), {})
+        _schema_cache[schema_file] = cached
+    return cached
+
+def get_validator(target):
+    signature, schemas, validators = get_schemas()
+    validator = validators.get(target)
+    if validator is None:
+        schema = schemas.get(target, {})
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        validators[target] = validator
+    return validator
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=8080)
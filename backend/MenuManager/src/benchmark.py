@@ -0,0 +1,247 @@
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import menu_cache
+import menu_generator
+import menu_index
+import menu_json
+from app import app
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Times every search mode and every mutation endpoint through the Flask test
+# client against a synthetic menu, and reports latency percentiles, how much
+# memory each case kept and the peak memory of the run as JSON so runs can be
+# compared:
+#
+#   python benchmark.py --restaurants 100 --output before.json
+#   python benchmark.py --restaurants 100 --output after.json --compare before.json
+
+ITEM_PATH = ['restaurants', 0, 'menus', 0, 'categories', 0, 'items']
+
+def new_item(n):
+    return {'name': f'Benchmark Item {n}', 'price': 4.5, 'dietary': ['Vegan'], 'rewardEligible': True}
+
+def case(name, method, url, body=None, headers=None, then=None):
+    # body builds the json body of the nth request, then is a url fetched
+    # straight after each request and timed along with it
+    return {'name': name, 'method': method, 'url': url, 'body': body, 'headers': headers or {}, 'then': then}
+
+def build_cases(menu):
+    # Queries are built from an item in the menu, so every search finds something
+    items = [node for level, node, path in menu_index.iter_nodes(menu) if level == 'items']
+    item = next((item for item in reversed(items) if len(item['dietary']) > 1), items[-1])
+    word = item['name'].split()[0]
+    tag = item['dietary'][0] if item['dietary'] else 'Vegan'
+    facets = ''.join(f'dietary_requirements={requirement}&' for requirement in item['dietary']) + f'reward_eligible={str(item["rewardEligible"]).lower()}'
+
+    return [
+        case('get_data', 'GET', '/api/get_data'),
+        case('get_data_gzip', 'GET', '/api/get_data', headers={'Accept-Encoding': 'gzip'}),
+        case('get_data_fields', 'GET', '/api/get_data?fields=name,price'),
+        case('get_data_restaurant', 'GET', '/api/get_data?restaurant=Restaurant 1'),
+        case('get_node_restaurants', 'GET', '/api/get_data/node?depth=1&counts=true'),
+        case('get_node_category', 'GET', '/api/get_data/node?path=restaurants/0/menus/0/categories/0'),
+        case('search_name_items', 'GET', f'/api/get_data/search?area=items&option=name&name={word}'),
+        case('search_name_short', 'GET', '/api/get_data/search?area=items&option=name&name=ch'),
+        case('search_name_all', 'GET', '/api/get_data/search?area=restaurants&option=name&name=*'),
+        case('search_name_limit', 'GET', f'/api/get_data/search?area=items&option=name&name={word}&limit=20'),
+        case('search_fuzzy_items', 'GET', f'/api/get_data/search?area=items&option=fuzzy&name={word[:-1]}&limit=20'),
+        case('search_contains_items', 'GET', f'/api/get_data/search?area=items&option=contains&name={tag}'),
+        case('search_contains_restaurants', 'GET', f'/api/get_data/search?area=restaurants&option=contains&name={tag}'),
+        case('search_dietary', 'GET', f'/api/get_data/search?dietary_requirements={tag}'),
+        case('search_reward', 'GET', '/api/get_data/search?reward_eligible=true'),
+        case('search_dietary_reward', 'GET', f'/api/get_data/search?{facets}'),
+        case('query_combined', 'GET', f'/api/get_data/query?{facets}&max_price=20'),
+        case('search_price_range', 'GET', '/api/get_data/search?min_price=5&max_price=10'),
+        case('search_cheapest', 'GET', f'/api/get_data/search?dietary_requirements={tag}&sort=price&limit=10'),
+        case('query_restaurants', 'GET', f'/api/get_data/query?area=restaurants&dietary_requirements={tag}&max_price=10'),
+        case('search_id', 'GET', f'/api/get_data/search?id={item["id"]}'),
+        case('search_id_all', 'GET', '/api/get_data/search?id=*&limit=50'),
+        case('get_items', 'POST', '/api/get_data/items', lambda n: {'ids': [item['id'], 'missing']}),
+        case('update_data', 'PUT', '/api/update_data',
+             lambda n: {'path': ITEM_PATH + [0], 'newData': {'name': f'Updated {n}', 'price': 5, 'rewardEligible': n % 2 == 0}}),
+        case('add_data', 'POST', '/api/add_data', lambda n: {'path': ITEM_PATH, 'newData': new_item(n)}),
+        # Removes the items added above, so the menu ends the size it started
+        case('delete_data', 'DELETE', '/api/delete_data', lambda n: {'path': ITEM_PATH + [-1]}),
+        case('batch', 'POST', '/api/batch', lambda n: {'operations': [
+            {'op': 'add', 'path': ITEM_PATH, 'newData': new_item(n)},
+            {'op': 'delete', 'path': ITEM_PATH + [-1]},
+        ]}),
+        # A read straight after a write pays for rebuilding the indexes
+        case('update_then_search', 'PUT', '/api/update_data',
+             lambda n: {'path': ['restaurants', 0, 'name'], 'newData': f'Restaurant {n}'},
+             then=f'/api/get_data/search?area=items&option=name&name={word}'),
+    ]
+
+def percentile(sorted_values, percent):
+    # Nearest rank
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def current_rss_kb():
+    # Resident memory right now. The peak only ever goes up, so it cannot
+    # tell the cases apart.
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return None
+
+def run_case(client, case, repeat):
+    timings = []
+    statuses = set()
+    rss_before = current_rss_kb()
+    for n in range(repeat + 1):
+        body = case['body'](n) if case['body'] else None
+        start = time.perf_counter_ns()
+        response = client.open(case['url'], method=case['method'], json=body, headers=case['headers'])
+        response.get_data()
+        statuses.add(response.status_code)
+        if case['then']:
+            response = client.get(case['then'])
+            response.get_data()
+        timings.append((time.perf_counter_ns() - start) / 1e6)
+
+    rss_after = current_rss_kb()
+
+    # The first request builds whatever the case needs and is reported apart
+    first = timings.pop(0)
+    timings.sort()
+    return {
+        'name': case['name'],
+        'method': case['method'],
+        'url': case['url'],
+        'statuses': sorted(statuses),
+        'requests': repeat,
+        'first_ms': round(first, 3),
+        'mean_ms': round(sum(timings) / len(timings), 3),
+        'p50_ms': round(percentile(timings, 50), 3),
+        'p95_ms': round(percentile(timings, 95), 3),
+        'p99_ms': round(percentile(timings, 99), 3),
+        'max_ms': round(timings[-1], 3),
+        # Memory the case left allocated, such as the indexes it built
+        'rss_change_kb': rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+    }
+
+def run_benchmarks(menu, repeat=100, storage='json', cases=None, result_cache=True):
+    directory = tempfile.mkdtemp(prefix='menu_benchmark')
+    menu_file = os.path.join(directory, 'menus.json')
+    with open(menu_file, 'w') as f:
+        json.dump(menu, f)
+
+    saved = {key: app.config.get(key) for key in ['MENU_FILE', 'MENU_STORAGE', 'MENU_SEARCH_CACHE_BYTES']}
+    app.config['MENU_FILE'] = menu_file
+    app.config['MENU_STORAGE'] = storage
+    if not result_cache:
+        # Time the searches themselves rather than cached responses
+        app.config['MENU_SEARCH_CACHE_BYTES'] = 0
+    try:
+        client = app.test_client()
+        results = []
+        for case in build_cases(menu):
+            if cases is None or case['name'] in cases:
+                results.append(run_case(client, case, repeat))
+        return results
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                app.config.pop(key, None)
+            else:
+                app.config[key] = value
+        shutil.rmtree(directory, ignore_errors=True)
+
+def run_startup(menu):
+    # How long a new worker takes to have the menu and its indexes ready,
+    # parsing the JSON and building the indexes, then from the warm start
+    # file the first load wrote
+    directory = tempfile.mkdtemp(prefix='menu_benchmark')
+    menu_file = os.path.join(directory, 'menus.json')
+    with open(menu_file, 'w') as f:
+        json.dump(menu, f)
+
+    try:
+        timings = {}
+        for name in ['cold', 'warm']:
+            menu_cache.clear_cache()
+            start = time.perf_counter_ns()
+            snapshot = menu_cache.get_snapshot(menu_file, warm_start=True)
+            for key, build in menu_cache.WARM_START_INDEXES.items():
+                snapshot.derived(key, build)
+            timings[f'{name}_ms'] = round((time.perf_counter_ns() - start) / 1e6, 3)
+            menu_cache.wait_for_warm_starts()
+        return timings
+    finally:
+        menu_cache.clear_cache()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def compare(results, baseline):
+    # p50 and p95 of this run as a ratio of the baseline (below 1 is faster)
+    previous = {result['name']: result for result in baseline['results']}
+    lines = []
+    for result in results['results']:
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        ratios = [f'{key[:-3]} {result[key] / before[key]:.2f}x' if before[key] else f'{key[:-3]} -'
+                  for key in ['p50_ms', 'p95_ms']]
+        lines.append(f'{result["name"]:<28} ' + '  '.join(ratios))
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MenuManager API')
+    menu_generator.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=100, help='timed requests per case')
+    parser.add_argument('--storage', default='json', help='MENU_STORAGE to benchmark')
+    parser.add_argument('--no-result-cache', action='store_true', help='turn off the search result cache')
+    parser.add_argument('--case', action='append', dest='cases', help='only run this case (can be repeated)')
+    parser.add_argument('--output', help='write the results here instead of stdout')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    menu = menu_generator.menu_from_arguments(args)
+    results = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'orjson': menu_json.orjson is not None,
+            'storage': args.storage,
+            'result_cache': not args.no_result_cache,
+            'repeat': args.repeat,
+            'menu': {key: getattr(args, key) for key in ['restaurants', 'menus', 'categories', 'items', 'dietary', 'reward_ratio', 'seed']},
+        },
+        'results': run_benchmarks(menu, args.repeat, args.storage, args.cases, not args.no_result_cache),
+        'startup': run_startup(menu),
+    }
+    results['peak_rss_kb'] = peak_rss_kb()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            print(compare(results, json.load(f)), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
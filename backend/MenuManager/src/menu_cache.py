@@ -0,0 +1,246 @@
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+import threading
+import time
+import menu_index
+import menu_json
+
+# Parsed copies of the menu file, shared by every request in this process.
+# A cached copy is only reused while the file's mtime, inode and size are
+# unchanged, so edits made outside the API (or by another worker) are picked up.
+# The cached data must be treated as read only, copy it before changing it.
+
+_lock = threading.Lock()
+_snapshots = {}
+_version = 0
+
+class MenuSnapshot:
+    def __init__(self, path, data, signature, version, derived=None, shared=None):
+        self.path = path
+        self._data = data
+        self.signature = signature
+        self.version = version
+        self._derived = dict(derived or {})
+        self._derived_lock = threading.RLock()
+        # Another snapshot of the same data, whose derived values are reused
+        self._shared = shared
+
+    @property
+    def data(self):
+        return self._data
+
+    # Sharded storages override these to answer without loading every
+    # restaurant. menu_root() is the top of the tree, its restaurants
+    # may be left out.
+    def menu_root(self):
+        return self.data
+
+    def restaurants_named(self, name):
+        return [restaurant for restaurant in self.data.get('restaurants', []) if restaurant.get('name') == name]
+
+    def restaurant_at(self, position):
+        restaurants = self.data.get('restaurants', [])
+        return restaurants[position] if 0 <= position < len(restaurants) else None
+
+    # Indexes and other values computed from the data are built once per
+    # snapshot, so they are rebuilt automatically whenever the menu changes.
+    def derived(self, key, build):
+        if self._shared is not None:
+            return self.cached(key, lambda: self._shared.derived(key, build))
+        return self.cached(key, lambda: build(self.data))
+
+    # Values that are not built from the whole menu (a single restaurant's
+    # view, a memo filled in later) are cached the same way
+    def cached(self, key, build):
+        try:
+            return self._derived[key]
+        except KeyError:
+            pass
+
+        with self._derived_lock:
+            if key not in self._derived:
+                self._derived[key] = build()
+            return self._derived[key]
+
+    # The same, built separately for each part of the menu that can be
+    # searched on its own. Unless the storage is sharded there is one part,
+    # the whole menu.
+    def derived_parts(self, key, build):
+        return [self.derived(key, build)]
+
+def file_signature(path):
+    return _signature(os.stat(path))
+
+def _signature(file_stat):
+    return (file_stat.st_mtime_ns, file_stat.st_ino, file_stat.st_size)
+
+def _next_version():
+    global _version
+    _version += 1
+    return _version
+
+def new_snapshot(path, data, signature, version=None, derived=None, shared=None):
+    if version is None:
+        version = _next_version()
+    return MenuSnapshot(path, data, signature, version, derived, shared)
+
+def get_snapshot(path, warm_start=False):
+    signature = file_signature(path)
+    snapshot = _snapshots.get(path)
+    if snapshot is not None and snapshot.signature == signature:
+        return snapshot
+
+    with _lock:
+        snapshot = _snapshots.get(path)
+        if snapshot is not None and snapshot.signature == signature:
+            return snapshot
+
+        # Take the signature from the open file so it matches what was read,
+        # even if the file is replaced while it is being parsed
+        with open(path, 'rb') as f:
+            signature = _signature(os.fstat(f.fileno()))
+            text = f.read()
+
+        warm = load_warm_start(path, text) if warm_start else None
+        if warm is not None:
+            data, derived = warm
+            snapshot = new_snapshot(path, data, signature, derived=derived)
+        else:
+            snapshot = new_snapshot(path, menu_json.load_menu(text), signature)
+            if warm_start:
+                write_warm_start_later(snapshot)
+
+        _snapshots[path] = snapshot
+        return snapshot
+
+def write_atomic(path, data):
+    write_bytes_atomic(path, menu_json.dumps(data))
+
+def write_bytes_atomic(path, body):
+    # Write to a temporary file next to the target and swap it into place, so
+    # readers only ever see the old or the new file, never a partial one.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def store_menu(path, data, warm_start=False):
+    with _lock:
+        write_atomic(path, data)
+
+        snapshot = new_snapshot(path, data, file_signature(path))
+        _snapshots[path] = snapshot
+
+    if warm_start:
+        write_warm_start_later(snapshot)
+    return snapshot
+
+# Warm start files hold the parsed menu and its search indexes, pickled next
+# to the menu file (menus.json.warm). A new worker loads them with one read
+# and an unpickle instead of parsing the JSON and building every index.
+#
+# The header holds a digest of the menu file the tree was parsed from and of
+# the code that builds the indexes. A warm start file that does not match
+# both is ignored and the menu is parsed as usual. The file is written by
+# the app next to the menu and is trusted as much as the menu itself.
+
+WARM_START_MAGIC = b'MENUWARM1\n'
+
+# The indexes kept in the file, by the key they are derived under
+WARM_START_INDEXES = {
+    'names': menu_index.build_name_indexes,
+    'ids': menu_index.build_id_index,
+    'facets': menu_index.build_facet_index,
+    'ancestors': menu_index.build_ancestor_index,
+    'prices': menu_index.build_price_index,
+}
+
+_code_digest = None
+_warm_pending = {}
+_warm_lock = threading.Lock()
+
+def warm_start_path(path):
+    return path + '.warm'
+
+def _warm_start_header(text):
+    global _code_digest
+    if _code_digest is None:
+        with open(menu_index.__file__, 'rb') as f:
+            _code_digest = hashlib.sha1(f.read()).digest()
+    return WARM_START_MAGIC + hashlib.sha1(text).digest() + _code_digest
+
+def load_warm_start(path, text):
+    # (data, derived values) for the menu file contents text, or None
+    try:
+        with open(warm_start_path(path), 'rb') as f:
+            body = f.read()
+    except FileNotFoundError:
+        return None
+
+    header = _warm_start_header(text)
+    if not body.startswith(header):
+        return None
+    try:
+        return pickle.loads(memoryview(body)[len(header):])
+    except Exception:
+        # A file left by a different version of the code
+        return None
+
+def write_warm_start(snapshot):
+    # snapshot must be the one get_snapshot() gives for its file. The indexes
+    # are built through it, so requests using it share them.
+    with open(snapshot.path, 'rb') as f:
+        text = f.read()
+        if _signature(os.fstat(f.fileno())) != snapshot.signature:
+            return False
+
+    derived = {key: snapshot.derived(key, build) for key, build in WARM_START_INDEXES.items()}
+    body = pickle.dumps((snapshot.data, derived), protocol=pickle.HIGHEST_PROTOCOL)
+    write_bytes_atomic(warm_start_path(snapshot.path), _warm_start_header(text) + body)
+    return True
+
+def write_warm_start_later(snapshot):
+    # Building the indexes takes longer than writing the menu, so it is done
+    # in the background. While a write is running only the newest snapshot
+    # waiting after it is written.
+    with _warm_lock:
+        running = snapshot.path in _warm_pending
+        _warm_pending[snapshot.path] = snapshot
+    if not running:
+        threading.Thread(target=_write_pending_warm_starts, args=(snapshot.path,), daemon=True).start()
+
+def _write_pending_warm_starts(path):
+    while True:
+        with _warm_lock:
+            snapshot = _warm_pending[path]
+            if snapshot is None:
+                del _warm_pending[path]
+                return
+            _warm_pending[path] = None
+        try:
+            write_warm_start(snapshot)
+        except OSError:
+            pass
+
+def wait_for_warm_starts():
+    while True:
+        with _warm_lock:
+            if not _warm_pending:
+                return
+        time.sleep(0.01)
+
+def clear_cache():
+    with _lock:
+        _snapshots.clear()
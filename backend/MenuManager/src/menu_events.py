@@ -0,0 +1,64 @@
+import queue
+import threading
+
+# Fans menu changes out to Server-Sent Events subscribers. Every subscriber
+# has its own bounded queue. A subscriber that lets its queue fill up is
+# dropped rather than holding up the others, and is told to resync.
+
+class Subscriber:
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.dropped = False
+
+class EventBroker:
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        subscriber = Subscriber(self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, change):
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(change)
+            except queue.Full:
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+def get_broker(storage, queue_size=100):
+    broker = _brokers.get(storage)
+    if broker is None:
+        with _brokers_lock:
+            broker = _brokers.get(storage)
+            if broker is None:
+                broker = EventBroker(queue_size)
+                storage.changes.listeners.append(broker.publish)
+                _brokers[storage] = broker
+    return broker
+
+def format_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {data}')
+    return '\n'.join(lines) + '\n\n'
@@ -0,0 +1,70 @@
+import argparse
+import json
+import random
+import uuid
+
+# Builds synthetic menus with the same shape as menus.json, for benchmarks
+# and load tests. The same parameters and seed always give the same menu.
+
+# Share of items that carry each dietary tag
+DIETARY_TAGS = {
+    'Vegetarian': 0.3,
+    'Vegan': 0.1,
+    'Gluten Free': 0.15,
+    'Halal': 0.1,
+    'Nut Free': 0.2,
+}
+
+MENU_NAMES = ['Breakfast', 'Lunch', 'Dinner', 'Drinks', 'Kids', 'Specials']
+CATEGORY_NAMES = ['Starters', 'Mains', 'Sides', 'Salads', 'Burgers', 'Pizza', 'Pasta', 'Desserts', 'Hot Drinks', 'Soft Drinks']
+ITEM_WORDS = ['Chicken', 'Beef', 'Tofu', 'Mushroom', 'Cheese', 'Pepperoni', 'Garlic', 'Tomato', 'Spicy', 'Classic',
+              'Grilled', 'Crispy', 'Smoked', 'Lemon', 'Chocolate', 'Vanilla', 'Berry', 'Caesar', 'Truffle', 'Avocado']
+ITEM_KINDS = ['Burger', 'Pizza', 'Salad', 'Wrap', 'Soup', 'Fries', 'Pasta', 'Cake', 'Shake', 'Latte', 'Tea', 'Bowl']
+
+def generate_item(rng, dietary, reward_ratio):
+    name = f'{rng.choice(ITEM_WORDS)} {rng.choice(ITEM_WORDS)} {rng.choice(ITEM_KINDS)}'
+    return {
+        'name': name,
+        'price': round(rng.uniform(1, 30), 2),
+        'dietary': [tag for tag, share in dietary.items() if rng.random() < share],
+        'rewardEligible': rng.random() < reward_ratio,
+        'id': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+    }
+
+def generate_menu(restaurants=10, menus=2, categories=5, items=20, dietary=None, reward_ratio=0.5, seed=0):
+    rng = random.Random(seed)
+    if dietary is None:
+        dietary = DIETARY_TAGS
+
+    return {'restaurants': [
+        {'name': f'Restaurant {r + 1}', 'menus': [
+            {'name': MENU_NAMES[m % len(MENU_NAMES)], 'categories': [
+                {'name': CATEGORY_NAMES[c % len(CATEGORY_NAMES)], 'items': [
+                    generate_item(rng, dietary, reward_ratio) for i in range(items)
+                ]} for c in range(categories)
+            ]} for m in range(menus)
+        ]} for r in range(restaurants)
+    ]}
+
+def add_arguments(parser):
+    parser.add_argument('--restaurants', type=int, default=10)
+    parser.add_argument('--menus', type=int, default=2, help='menus per restaurant')
+    parser.add_argument('--categories', type=int, default=5, help='categories per menu')
+    parser.add_argument('--items', type=int, default=20, help='items per category')
+    parser.add_argument('--dietary', type=json.loads, default=None,
+                        help='JSON object of dietary tag -> share of items with it')
+    parser.add_argument('--reward-ratio', type=float, default=0.5, help='share of items that are reward eligible')
+    parser.add_argument('--seed', type=int, default=0)
+
+def menu_from_arguments(args):
+    return generate_menu(args.restaurants, args.menus, args.categories, args.items,
+                         args.dietary, args.reward_ratio, args.seed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic menu file')
+    add_arguments(parser)
+    parser.add_argument('output', help='where to write the menu')
+    args = parser.parse_args()
+
+    with open(args.output, 'w') as f:
+        json.dump(menu_from_arguments(args), f)
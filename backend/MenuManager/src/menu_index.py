@@ -0,0 +1,329 @@
+from array import array
+from bisect import bisect_left, bisect_right
+
+LEVELS = ('restaurants', 'menus', 'categories', 'items')
+
+def iter_nodes(data):
+    for r, restaurant in enumerate(data.get('restaurants', [])):
+        restaurant_path = ['restaurants', r]
+        yield 'restaurants', restaurant, restaurant_path
+        for m, menu in enumerate(restaurant.get('menus', [])):
+            menu_path = restaurant_path + ['menus', m]
+            yield 'menus', menu, menu_path
+            for c, category in enumerate(menu.get('categories', [])):
+                category_path = menu_path + ['categories', c]
+                yield 'categories', category, category_path
+                for i, item in enumerate(category.get('items', [])):
+                    yield 'items', item, category_path + ['items', i]
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class NameIndex:
+    # Trigram index over the lowercased names of one level of the menu tree.
+    # Substring queries of three or more characters only look at the nodes
+    # that share every trigram of the query, shorter ones fall back to a scan
+    # of the precomputed lowercase names. Postings are arrays of 32 bit
+    # positions rather than lists of int objects to keep the index small.
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.names = [str(node.get('name', '')).lower() for node in nodes]
+        self.postings = {}
+        for position, name in enumerate(self.names):
+            for gram in trigrams(name):
+                self.postings.setdefault(gram, array('I')).append(position)
+
+    def positions(self, search_name):
+        if search_name == '*':
+            return list(range(len(self.nodes)))
+
+        query = search_name.lower()
+        if len(query) < 3:
+            return [position for position, name in enumerate(self.names) if query in name]
+
+        lists = []
+        for gram in trigrams(query):
+            posting = self.postings.get(gram)
+            if not posting:
+                return []
+            lists.append(posting)
+        lists.sort(key=len)
+
+        candidates = set(lists[0])
+        for posting in lists[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return []
+
+        return [position for position in sorted(candidates) if query in self.names[position]]
+
+    def estimate(self, search_name):
+        # An upper bound on the number of matches, without running the search
+        query = search_name.lower()
+        if search_name == '*' or len(query) < 3:
+            return len(self.nodes)
+        return min(len(self.postings.get(gram, ())) for gram in trigrams(query))
+
+    def search(self, search_name):
+        return [self.nodes[position] for position in self.positions(search_name)]
+
+# Names scoring below this against a fuzzy query are left out
+FUZZY_THRESHOLD = 0.3
+
+def word_trigrams(text):
+    # Each word is padded, two spaces in front and one behind as in
+    # PostgreSQL's pg_trgm, so the start and end of words count for more
+    grams = set()
+    for word in text.split():
+        grams.update(trigrams(f'  {word} '))
+    return grams
+
+class FuzzyIndex:
+    # Typo tolerant name matching for one level of the menu tree. Names are
+    # scored by the Dice coefficient of their word trigrams and the query's,
+    # so "peperoni" still finds "Pepperoni" and "motzarella" "Mozzarella".
+    # Only names sharing at least one trigram with the query are scored.
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.sizes = []
+        self.postings = {}
+        for position, node in enumerate(nodes):
+            grams = word_trigrams(str(node.get('name', '')).lower())
+            self.sizes.append(len(grams))
+            for gram in grams:
+                self.postings.setdefault(gram, array('I')).append(position)
+
+    def scored(self, query, threshold=FUZZY_THRESHOLD):
+        # (score, node) pairs, best first, ties in tree order
+        grams = word_trigrams(query.lower())
+        shared = {}
+        for gram in grams:
+            for position in self.postings.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+
+        scores = []
+        for position, count in shared.items():
+            score = 2 * count / (len(grams) + self.sizes[position])
+            if score >= threshold:
+                scores.append((-score, position))
+        scores.sort()
+        return [(-score, self.nodes[position]) for score, position in scores]
+
+def build_fuzzy_indexes(data):
+    nodes = {level: [] for level in LEVELS}
+    for level, node, path in iter_nodes(data):
+        nodes[level].append(node)
+    return {level: FuzzyIndex(level_nodes) for level, level_nodes in nodes.items()}
+
+def build_name_indexes(data):
+    nodes = {level: [] for level in LEVELS}
+    for level, node, path in iter_nodes(data):
+        nodes[level].append(node)
+    return {level: NameIndex(level_nodes) for level, level_nodes in nodes.items()}
+
+def build_id_index(data):
+    # Item id -> list of (item, path) pairs. Ids are meant to be unique but
+    # nothing stops the same id appearing twice, so every match is kept.
+    index = {}
+    for level, node, path in iter_nodes(data):
+        if level == 'items' and 'id' in node:
+            index.setdefault(node['id'], []).append((node, path))
+    return index
+
+def _bitmap(positions, size):
+    buffer = bytearray((size + 7) // 8)
+    for position in positions:
+        buffer[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(buffer, 'little')
+
+class FacetIndex:
+    # Bitsets over the items of the menu in tree order, one per dietary tag
+    # and per rewardEligible value. Bit n is set when the nth item has the facet,
+    # so combining filters is a bitwise AND of ints.
+
+    def __init__(self, items):
+        self.items = items
+        self.all = (1 << len(items)) - 1
+
+        dietary = {}
+        any_dietary = []
+        reward = {True: [], False: []}
+        for position, item in enumerate(items):
+            tags = item.get('dietary', [])
+            if tags:
+                any_dietary.append(position)
+            for tag in set(tags):
+                dietary.setdefault(tag, []).append(position)
+            if item.get('rewardEligible') in reward:
+                reward[item['rewardEligible']].append(position)
+
+        size = len(items)
+        self.dietary = {tag: _bitmap(positions, size) for tag, positions in dietary.items()}
+        self.any_dietary = _bitmap(any_dietary, size)
+        self.reward = {value: _bitmap(positions, size) for value, positions in reward.items()}
+
+    def dietary_bits(self, requirement):
+        if requirement == '*':
+            return self.any_dietary
+        return self.dietary.get(requirement, 0)
+
+    def reward_bits(self, eligible):
+        return self.reward[eligible]
+
+    def select(self, bits):
+        return [self.items[position] for position, bit in enumerate(bin(bits)[:1:-1]) if bit == '1']
+
+def build_facet_index(data):
+    return FacetIndex([node for level, node, path in iter_nodes(data) if level == 'items'])
+
+def item_price(item):
+    price = item.get('price')
+    if isinstance(price, (int, float)) and not isinstance(price, bool):
+        return price
+    return None
+
+class PriceIndex:
+    # Item positions (in tree order) sorted by price, cheapest first, with
+    # equal prices kept in tree order. Price ranges are found with bisect.
+    # Items without a numeric price are kept apart, in tree order.
+
+    def __init__(self, items):
+        prices = [item_price(item) for item in items]
+        priced = sorted((price, position) for position, price in enumerate(prices) if price is not None)
+        self.prices = array('d', [price for price, position in priced])
+        self.positions = array('I', [position for price, position in priced])
+        self.unpriced = array('I', [position for position, price in enumerate(prices) if price is None])
+
+    def bounds(self, min_price=None, max_price=None):
+        start = 0 if min_price is None else bisect_left(self.prices, min_price)
+        end = len(self.prices) if max_price is None else bisect_right(self.prices, max_price)
+        return start, max(start, end)
+
+    def count(self, min_price=None, max_price=None):
+        start, end = self.bounds(min_price, max_price)
+        return end - start
+
+    def range(self, min_price=None, max_price=None):
+        start, end = self.bounds(min_price, max_price)
+        return self.positions[start:end]
+
+def build_price_index(data):
+    return PriceIndex([node for level, node, path in iter_nodes(data) if level == 'items'])
+
+class AncestorIndex:
+    # For each item in tree order, the position of its restaurant, menu and
+    # category among the nodes of their level
+    def __init__(self, data):
+        self.parents = {level: array('I') for level in LEVELS[:-1]}
+        current = {level: -1 for level in LEVELS[:-1]}
+        for level, node, path in iter_nodes(data):
+            if level == 'items':
+                for ancestor, positions in self.parents.items():
+                    positions.append(current[ancestor])
+            else:
+                current[level] += 1
+
+def build_ancestor_index(data):
+    return AncestorIndex(data)
+
+CHILD_LEVEL = {'restaurants': 'menus', 'menus': 'categories', 'categories': 'items', 'items': None}
+
+def _string_leaves(value, leaves):
+    if isinstance(value, dict):
+        for child in value.values():
+            _string_leaves(child, leaves)
+    elif isinstance(value, list):
+        for child in value:
+            _string_leaves(child, leaves)
+    elif isinstance(value, str):
+        leaves.add(value)
+
+class ContainsIndex:
+    # Reverse index from every string value in the menu to the nodes, at each
+    # level, that have it somewhere beneath them. Search values always come in
+    # as strings, so other leaves (prices, flags) can never match and are skipped.
+
+    def __init__(self, data):
+        self.nodes = {level: [] for level in LEVELS}
+        self.values = {}
+        current = {}
+
+        for level, node, path in iter_nodes(data):
+            depth = LEVELS.index(level)
+            current[level] = len(self.nodes[level])
+            self.nodes[level].append(node)
+
+            leaves = set()
+            child_level = CHILD_LEVEL[level]
+            for key, value in node.items():
+                if key != child_level:
+                    _string_leaves(value, leaves)
+
+            for leaf in leaves:
+                owners = self.values.setdefault(leaf, {})
+                for ancestor in LEVELS[:depth + 1]:
+                    owners.setdefault(ancestor, set()).add(current[ancestor])
+
+    def search(self, level, search_value):
+        positions = self.values.get(search_value, {}).get(level, ())
+        return [self.nodes[level][position] for position in sorted(positions)]
+
+def build_contains_index(data):
+    return ContainsIndex(data)
+
+def build_field_names(data):
+    names = set()
+    for level, node, path in iter_nodes(data):
+        names.update(node.keys())
+    return names
+
+def project(node, fields, memo):
+    # Keeps only the given fields of a node. The child lists that make up the
+    # menu tree are always kept (and projected) so the shape stays the same.
+    key = id(node)
+    projected = memo.get(key)
+    if projected is None:
+        projected = {field: node[field] for field in fields if field in node and field not in LEVELS}
+        for level in LEVELS:
+            if isinstance(node.get(level), list):
+                projected[level] = [project(child, fields, memo) for child in node[level]]
+        memo[key] = projected
+    return projected
+
+def find_node(data, path):
+    # The node (or list of nodes) at path, None when there is nothing there
+    node = data
+    for key in path:
+        if isinstance(node, dict) and isinstance(key, str) and key in node:
+            node = node[key]
+        elif isinstance(node, list) and isinstance(key, int) and 0 <= key < len(node):
+            node = node[key]
+        else:
+            return None
+    return node
+
+def subtree(node, depth=None, counts=False):
+    # A copy of node with the child lists more than depth levels down left
+    # out. With counts every node that has children says how many in
+    # childCount, so a client can tell which nodes are worth expanding.
+    if isinstance(node, list):
+        return [subtree(child, depth, counts) for child in node]
+    if not isinstance(node, dict):
+        return node
+
+    result = {key: value for key, value in node.items() if key not in LEVELS}
+    for level in LEVELS:
+        children = node.get(level)
+        if not isinstance(children, list):
+            continue
+        if counts:
+            result['childCount'] = len(children)
+        if depth is None or depth > 0:
+            result[level] = [subtree(child, None if depth is None else depth - 1, counts) for child in children]
+    return result
+
+def restaurant_scope(restaurants):
+    # ids of every node that belongs to one of the given restaurants
+    return {id(node) for level, node, path in iter_nodes({'restaurants': restaurants})}
@@ -0,0 +1,74 @@
+import json
+import math
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON encoding and decoding for the menu. orjson is used when it is
+# installed, otherwise the standard library with the same compact output.
+# They differ on numbers JSON cannot hold: orjson writes NaN and infinity
+# as null and cannot write integers outside 64 bits, while the standard
+# library (as used here) refuses NaN and infinity. The API rejects such
+# numbers before they are stored (see numbers_fit), and files that already
+# have them are read with them turned into what both can write.
+
+# Strings longer than this (descriptions, image urls) are rarely repeated
+INTERN_MAX_LENGTH = 64
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, allow_nan=False).encode('utf-8')
+
+# orjson can write integers from -2**63 up to 2**64 - 1
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 64 - 1
+
+def _finite(value):
+    return value if math.isfinite(value) else None
+
+def _int(text):
+    value = int(text)
+    return value if INT_MIN <= value <= INT_MAX else _finite(float(text))
+
+def loads(text):
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            # NaN, infinity and integers too big for orjson, read below
+            pass
+    return json.loads(text, parse_constant=lambda name: None, parse_int=_int, parse_float=lambda text: _finite(float(text)))
+
+def numbers_fit(value):
+    # Whether every number in value can be written by both encoders: finite,
+    # and integers within the range orjson handles
+    if isinstance(value, dict):
+        return all(numbers_fit(child) for child in value.values())
+    if isinstance(value, list):
+        return all(numbers_fit(child) for child in value)
+    if isinstance(value, bool):
+        return True
+    if isinstance(value, int):
+        return INT_MIN <= value <= INT_MAX
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return True
+
+def intern_strings(value):
+    # Menus repeat the same short strings over and over: keys, dietary tags,
+    # category and item names. The parser makes a new copy of each one, so
+    # the tree is rebuilt sharing a single copy of every short string.
+    if isinstance(value, dict):
+        return {sys.intern(key): intern_strings(child) for key, child in value.items()}
+    if isinstance(value, list):
+        return [intern_strings(child) for child in value]
+    if isinstance(value, str) and len(value) <= INTERN_MAX_LENGTH:
+        return sys.intern(value)
+    return value
+
+def load_menu(text):
+    return intern_strings(loads(text))
@@ -0,0 +1,63 @@
+import gzip
+import hashlib
+import re
+import threading
+import menu_json
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# The serialised menu for one snapshot, plus its compressed variants.
+# Each variant is compressed the first time a client asks for it and then
+# reused until the menu changes.
+
+class MenuPayload:
+    def __init__(self, body):
+        self.body = body
+        self.etag = hashlib.sha256(body).hexdigest()
+        self._encoded = {'identity': body}
+        self._lock = threading.Lock()
+
+    def encodings(self):
+        if brotli is not None:
+            return ['br', 'gzip']
+        return ['gzip']
+
+    def variant_etag(self, encoding):
+        if encoding == 'identity':
+            return self.etag
+        return f'{self.etag}-{encoding}'
+
+    def etags(self):
+        return [self.variant_etag(encoding) for encoding in ['identity'] + self.encodings()]
+
+    def negotiate(self, accept_encodings):
+        for encoding in self.encodings():
+            if accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+    def encoded(self, encoding):
+        try:
+            return self._encoded[encoding]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if encoding not in self._encoded:
+                if encoding == 'br':
+                    self._encoded[encoding] = brotli.compress(self.body)
+                elif encoding == 'gzip':
+                    self._encoded[encoding] = gzip.compress(self.body, compresslevel=9, mtime=0)
+                else:
+                    raise ValueError(f'Unsupported encoding {encoding}')
+            return self._encoded[encoding]
+
+def is_etag(tag):
+    # Shaped like an ETag from variant_etag, whichever menu it was for
+    return re.fullmatch(r'[0-9a-f]{64}(-[a-z]+)?', tag) is not None
+
+def build_payload(data):
+    return MenuPayload(menu_json.dumps(data))
@@ -0,0 +1,121 @@
+import heapq
+import menu_index
+
+# Runs searches that combine several filters on one level of the menu:
+#
+#   name          substring of the names at that level
+#   dietary       dietary tags every matching item has ('*' for any)
+#   reward        rewardEligible of matching items
+#   min_price     lowest matching item price
+#   max_price     highest matching item price
+#
+# Items can also be returned cheapest first (sort='price'), in the order of
+# the price index rather than by sorting the results.
+#
+# Item filters are answered as bitsets over the items of each part of the
+# menu (see MenuSnapshot.derived_parts). The filter expected to match the
+# fewest items runs first. Every later filter is either intersected with
+# the candidates as a bitset or, when there are fewer candidates than it
+# would match, checked against each remaining candidate instead. Searching
+# a level above items keeps the nodes that hold at least one matching item.
+
+ITEMS = 'items'
+
+def _positions(bits):
+    return [position for position, bit in enumerate(bin(bits)[:1:-1]) if bit == '1']
+
+def _bits(positions, size):
+    return menu_index._bitmap(positions, size)
+
+def price_in_range(item, min_price=None, max_price=None):
+    price = menu_index.item_price(item)
+    if price is None:
+        return False
+    return (min_price is None or price >= min_price) and (max_price is None or price <= max_price)
+
+def item_filters(part, name, dietary, reward, min_price, max_price):
+    # (estimated matches, build the bitset of matches, check one item)
+    names, facets, ancestors, prices = part
+    items = facets.items
+    size = len(items)
+    filters = []
+
+    if name is not None:
+        index = names[ITEMS]
+        query = name.lower()
+        filters.append((index.estimate(name),
+                        lambda: _bits(index.positions(name), size),
+                        lambda position: query == '*' or query in index.names[position]))
+
+    for requirement in dietary:
+        bits = facets.dietary_bits(requirement)
+        filters.append((bits.bit_count(), lambda bits=bits: bits, lambda position, bits=bits: bits >> position & 1))
+
+    if reward is not None:
+        bits = facets.reward_bits(reward)
+        filters.append((bits.bit_count(), lambda: bits, lambda position: bits >> position & 1))
+
+    if min_price is not None or max_price is not None:
+        filters.append((prices.count(min_price, max_price),
+                        lambda: _bits(prices.range(min_price, max_price), size),
+                        lambda position: price_in_range(items[position], min_price, max_price)))
+
+    return filters
+
+def plan(filters):
+    filters = sorted(filters, key=lambda entry: entry[0])
+    candidates = None
+    for estimate, build, check in filters:
+        if candidates is None:
+            candidates = build()
+        elif candidates.bit_count() < estimate:
+            candidates = _bits([position for position in _positions(candidates) if check(position)], candidates.bit_length())
+        else:
+            candidates &= build()
+        if not candidates:
+            return 0
+    return candidates
+
+def by_price(part, bits):
+    # The matching items cheapest first, read off the price index, then any
+    # without a price in tree order
+    names, facets, ancestors, prices = part
+    items = facets.items
+    matching = set(_positions(bits))
+    return [items[position] for positions in [prices.positions, prices.unpriced] for position in positions if position in matching]
+
+def run_part(part, area, name=None, dietary=(), reward=None, min_price=None, max_price=None, sort=None):
+    names, facets, ancestors, prices = part
+    item_name = name if area == ITEMS else None
+    filters = item_filters(part, item_name, dietary, reward, min_price, max_price)
+
+    if area == ITEMS:
+        bits = plan(filters) if filters else facets.all
+        if sort == 'price':
+            return by_price(part, bits)
+        return facets.select(bits)
+
+    nodes = names[area].nodes
+    if filters:
+        parents = ancestors.parents[area]
+        positions = sorted({parents[position] for position in _positions(plan(filters))})
+    else:
+        positions = range(len(nodes))
+    if name is not None:
+        positions = sorted(set(positions).intersection(names[area].positions(name)))
+    return [nodes[position] for position in positions]
+
+def price_key(item):
+    price = menu_index.item_price(item)
+    return (price is None, price or 0)
+
+def run_query(parts, area, **query):
+    results = [run_part(part, area, **query) for part in parts]
+    if query.get('sort') == 'price' and len(results) > 1:
+        # Each part is already in price order; ties stay in menu order
+        return list(heapq.merge(*results, key=price_key))
+    return [node for part in results for node in part]
+
+def sort_by_price(items):
+    # Stable, so equal prices stay in menu order, and unpriced items go last
+    return sorted(items, key=price_key)
@@ -0,0 +1,74 @@
+import threading
+from collections import OrderedDict
+
+# Serialised search responses, so repeated queries are answered without
+# searching or encoding again. Keys include the menu version, and the cache
+# is emptied whenever the storage records a change, so a stale result is
+# never served. The least recently used responses are dropped once the
+# bodies add up to more than max_bytes.
+
+class SizedCache:
+    # An LRU of values with a known size, dropping the least recently used
+    # ones once the sizes add up to more than max_bytes
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # Values too big to keep a few of are not worth evicting others for
+        self.max_entry_bytes = max_bytes // 4
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_entry_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.size -= evicted[1]
+
+    def clear(self, change=None):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+class ResultCache(SizedCache):
+    def put(self, key, body, status, headers):
+        super().put(key, (body, status, headers), len(body))
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(storage, max_bytes):
+    key = (storage, max_bytes)
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                cache = ResultCache(max_bytes)
+                storage.changes.listeners.append(cache.clear)
+                _caches[key] = cache
+    return cache
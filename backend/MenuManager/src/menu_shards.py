@@ -0,0 +1,240 @@
+import os
+import threading
+import time
+import uuid
+import menu_cache
+import menu_json
+import menu_storage
+
+# Stores each restaurant in its own file, in a directory next to the menu
+# file, with a small manifest listing them in order:
+#
+#   {"version": 12, "root": {... "restaurants": null ...},
+#    "restaurants": [{"name": "Restaurant A", "file": "<id>.json"}, ...]}
+#
+# Shard files are never changed once written. A commit writes new files for
+# the restaurants it touched and then swaps in a new manifest, so a reader
+# always sees the restaurants of one manifest. Shards are only read when a
+# request needs them, and the indexes built from each one are kept until it
+# is replaced, so a change to one restaurant only re-reads and re-indexes
+# that restaurant.
+
+MANIFEST = 'manifest.json'
+
+# Shard files the manifest no longer lists are kept this long after they
+# were replaced, for requests still reading an older manifest
+UNUSED_SHARD_SECONDS = 60
+
+def shard_directory(path):
+    return os.path.splitext(path)[0] + '.shards'
+
+class ShardedSnapshot(menu_cache.MenuSnapshot):
+    def __init__(self, storage, manifest, signature, version):
+        super().__init__(storage.path, None, signature, version)
+        self.manifest = manifest
+        self._storage = storage
+
+    @property
+    def data(self):
+        # The whole tree is only put together when something needs all of it
+        if self._data is None:
+            with self._derived_lock:
+                if self._data is None:
+                    self._data = dict(self.menu_root(), restaurants=self.restaurants())
+        return self._data
+
+    def menu_root(self):
+        return self.manifest['root']
+
+    def restaurants(self):
+        return [self._storage.load_shard(entry['file']) for entry in self.manifest['restaurants']]
+
+    def restaurants_named(self, name):
+        return [self._storage.load_shard(entry['file']) for entry in self.manifest['restaurants'] if entry['name'] == name]
+
+    def restaurant_at(self, position):
+        entries = self.manifest['restaurants']
+        return self._storage.load_shard(entries[position]['file']) if 0 <= position < len(entries) else None
+
+    def derived_parts(self, key, build):
+        return [self._storage.shard_derived(entry['file'], key, build) for entry in self.manifest['restaurants']]
+
+class ShardedStorage:
+    # The menu file is split into shards the first time the storage is used,
+    # after that the menu file is no longer read. Versions are kept in the
+    # manifest, so every worker agrees on them, but a worker only knows the
+    # operations it applied itself: changes made by another worker make the
+    # change feed ask clients to resync.
+
+    def __init__(self, path, directory=None, changes_kept=1000):
+        self.path = path
+        self.directory = directory or shard_directory(path)
+        self.manifest_path = os.path.join(self.directory, MANIFEST)
+        self.changes = menu_storage.ChangeLog(changes_kept)
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._manifest_signature = None
+        # Shard file -> parsed restaurant, and (shard file, key) -> value built from it
+        self._shards = {}
+        self._shard_derived = {}
+        self._shards_lock = threading.Lock()
+
+    def _manifest_stat(self):
+        try:
+            return menu_cache.file_signature(self.manifest_path)
+        except FileNotFoundError:
+            return None
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None and self._manifest_stat() == self._manifest_signature:
+            return snapshot
+
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self):
+        if not os.path.exists(self.manifest_path):
+            self.split_menu()
+
+        with open(self.manifest_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+            if self._snapshot is not None and signature == self._manifest_signature:
+                return self._snapshot
+            manifest = menu_json.load_menu(f.read())
+
+        if self._snapshot is None or manifest['version'] != self.changes.version:
+            self.changes.reset(manifest['version'])
+        self._forget_unused(manifest)
+        self._manifest_signature = signature
+        self._snapshot = ShardedSnapshot(self, manifest, ('shards', signature), manifest['version'])
+        return self._snapshot
+
+    def split_menu(self):
+        with self._lock, menu_storage.file_lock(self.path):
+            if os.path.exists(self.manifest_path):
+                return
+
+            with open(self.path, 'rb') as f:
+                data = menu_json.load_menu(f.read())
+            os.makedirs(self.directory, exist_ok=True)
+            entries = [self._write_shard(restaurant) for restaurant in data.get('restaurants', [])]
+            self._write_manifest(0, dict(data, restaurants=None), entries)
+
+    def load_shard(self, name):
+        try:
+            return self._shards[name]
+        except KeyError:
+            pass
+
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            restaurant = menu_json.load_menu(f.read())
+        with self._shards_lock:
+            return self._shards.setdefault(name, restaurant)
+
+    def shard_derived(self, name, key, build):
+        try:
+            return self._shard_derived[(name, key)]
+        except KeyError:
+            pass
+
+        value = build({'restaurants': [self.load_shard(name)]})
+        with self._shards_lock:
+            return self._shard_derived.setdefault((name, key), value)
+
+    def _forget_unused(self, manifest):
+        used = {entry['file'] for entry in manifest['restaurants']}
+        with self._shards_lock:
+            for name in [name for name in self._shards if name not in used]:
+                del self._shards[name]
+            for key in [key for key in self._shard_derived if key[0] not in used]:
+                del self._shard_derived[key]
+
+    def _write_shard(self, restaurant):
+        name = f'{uuid.uuid4().hex}.json'
+        menu_cache.write_atomic(os.path.join(self.directory, name), restaurant)
+        with self._shards_lock:
+            self._shards[name] = restaurant
+        return {'name': restaurant.get('name'), 'file': name}
+
+    def _write_manifest(self, version, root, entries):
+        manifest = {'version': version, 'root': root, 'restaurants': entries}
+        menu_cache.write_atomic(self.manifest_path, manifest)
+        return manifest
+
+    def _remove_unused_shards(self, previous, manifest):
+        used = {entry['file'] for entry in manifest['restaurants']}
+        # The time a shard stops being used is when its grace period starts
+        for entry in previous['restaurants']:
+            if entry['file'] not in used:
+                os.utime(os.path.join(self.directory, entry['file']))
+        cutoff = time.time() - UNUSED_SHARD_SECONDS
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.json') and name != MANIFEST and name not in used and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+
+    def _restaurant(self, entry):
+        if 'node' in entry:
+            return entry['node']
+        return self.load_shard(entry['file'])
+
+    def _apply(self, root, entries, operation):
+        # Changes inside one restaurant are applied to that restaurant only,
+        # anything else to the whole tree
+        path = operation['path']
+        if len(path) > 1 and path[0] == 'restaurants' and isinstance(path[1], int):
+            position = path[1]
+            if len(path) == 2 and operation['op'] == 'delete':
+                del entries[position]
+                return root
+            if len(path) == 2:
+                restaurant = operation['value']
+            else:
+                restaurant = menu_storage.apply_operation(self._restaurant(entries[position]), dict(operation, path=path[2:]))
+            entries[position] = {'name': restaurant.get('name'), 'node': restaurant}
+            return root
+
+        if path == ['restaurants'] and operation['op'] == 'add':
+            entries.append({'name': operation['value'].get('name'), 'node': operation['value']})
+            return root
+
+        restaurants = [self._restaurant(entry) for entry in entries]
+        data = menu_storage.apply_operation(dict(root, restaurants=restaurants), operation)
+        # Restaurants the operation did not touch are the same objects, so
+        # they keep their shard files
+        unchanged = {id(restaurant): entry for restaurant, entry in zip(restaurants, entries)}
+        entries[:] = [unchanged.get(id(restaurant)) or {'name': restaurant.get('name'), 'node': restaurant}
+                      for restaurant in data['restaurants']]
+        return dict(data, restaurants=None)
+
+    def commit(self, operations, if_version=None):
+        # split_menu takes the file lock itself, so the shards are made first
+        self.snapshot()
+        with self._lock, menu_storage.file_lock(self.path):
+            current = self.snapshot()
+            menu_storage.check_version(current.version, if_version)
+
+            root = current.menu_root()
+            entries = list(current.manifest['restaurants'])
+            for operation in operations:
+                root = self._apply(root, entries, operation)
+
+            entries = [self._write_shard(entry['node']) if 'node' in entry else entry for entry in entries]
+            manifest = self._write_manifest(current.version + len(operations), root, entries)
+
+            for operation in operations:
+                self.changes.record(self.changes.version + 1, operation)
+            self._manifest_signature = self._manifest_stat()
+            self._snapshot = ShardedSnapshot(self, manifest, ('shards', self._manifest_signature), self.changes.version)
+            self._forget_unused(manifest)
+            self._remove_unused_shards(current.manifest, manifest)
+            return self._snapshot
+
+    def changes_since(self, version):
+        with self._lock:
+            self.snapshot()
+            return self.changes.version, self.changes.since(version)
+
+menu_storage.STORAGE_TYPES['sharded'] = ShardedStorage
@@ -0,0 +1,573 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+from array import array
+from bisect import bisect_right
+import menu_cache
+import menu_index
+import menu_json
+import menu_payload
+import menu_storage
+
+# Keeps the menu and its indexes in one read only file per version (a
+# generation) that every worker maps into memory, so the catalog is held once
+# by the operating system rather than once per worker process:
+#
+#   menus.shared/current           the name of the current generation
+#   menus.shared/<id>.menu         a generation
+#
+# A generation is the serialised menu followed by sections of fixed width
+# arrays that address it by byte offset: where each restaurant, menu,
+# category and item starts and ends, their lowercased names, item ids,
+# prices, dietary tags and reward flags, and each node's parent. A JSON
+# header at the end lists the sections:
+#
+#   MAGIC | menu | sections... | header | header offset, header length | MAGIC
+#
+# Searches run on the mapped arrays and only the nodes they return are
+# parsed, each from its own bytes, and kept for as long as the generation is
+# current. Anything the sections cannot answer (contains and fuzzy searches,
+# field projections, writes) puts the whole tree together from the same
+# nodes, in that worker only.
+#
+# A commit writes a new generation and then replaces current, so a worker
+# switches to the new generation as a whole the next time it looks.
+
+MAGIC = b'MENUSHM1'
+CURRENT = 'current'
+
+# Generation files current no longer names are kept this long after they
+# were replaced, for workers that read current just before it changed
+UNUSED_GENERATION_SECONDS = 60
+
+LEVELS = menu_index.LEVELS
+CHILD_LEVEL = menu_index.CHILD_LEVEL
+ITEMS = 'items'
+
+def shared_directory(path):
+    return os.path.splitext(path)[0] + '.shared'
+
+class GenerationBuilder:
+    # Serialises the menu the same way menu_json.dumps does, writing each
+    # node itself so the offsets of every node can be recorded on the way
+
+    def __init__(self):
+        self.menu = bytearray()
+        self.spans = {level: array('Q') for level in LEVELS}
+        self.names = {level: [] for level in LEVELS}
+        self.own = {level: [] for level in LEVELS[:-1]}
+        self.children = {level: array('I') for level in LEVELS[:-1]}
+        self.parent = {level: array('I') for level in LEVELS[1:]}
+        self.ancestors = {level: array('I') for level in LEVELS[:-1]}
+        self.field_names = set()
+        self.items = []
+
+    def write_root(self, data):
+        root = {}
+        self.menu += b'{'
+        for n, (key, value) in enumerate(data.items()):
+            self.menu += (b',' if n else b'') + menu_json.dumps(key) + b':'
+            if key == 'restaurants' and isinstance(value, list):
+                self.write_children('restaurants', value, None)
+                root[key] = None
+            else:
+                self.menu += menu_json.dumps(value)
+                root[key] = value
+        self.menu += b'}'
+        return root
+
+    def write_children(self, level, nodes, parent):
+        self.menu += b'['
+        for n, node in enumerate(nodes):
+            if n:
+                self.menu += b','
+            self.write_node(level, node, parent)
+        self.menu += b']'
+
+    def write_node(self, level, node, parent):
+        position = len(self.names[level])
+        start = len(self.menu)
+        self.names[level].append(str(node.get('name', '')).lower())
+        self.field_names.update(node)
+        if parent is not None:
+            self.parent[level].append(parent)
+
+        child_level = CHILD_LEVEL[level]
+        if child_level is None:
+            self.menu += menu_json.dumps(node)
+            self.items.append(node)
+            for ancestor, positions in self.ancestors.items():
+                # The newest node of each level above is this item's ancestor
+                positions.append(len(self.names[ancestor]) - 1)
+        else:
+            # The node's own fields, with its child list left as null, so it
+            # can be parsed without its children
+            own = {}
+            children = None
+            self.menu += b'{'
+            for n, (key, value) in enumerate(node.items()):
+                self.menu += (b',' if n else b'') + menu_json.dumps(key) + b':'
+                if key == child_level and isinstance(value, list):
+                    first = len(self.names[child_level])
+                    self.write_children(child_level, value, position)
+                    children = (first, len(self.names[child_level]), 1)
+                    own[key] = None
+                else:
+                    self.menu += menu_json.dumps(value)
+                    own[key] = value
+            self.menu += b'}'
+            self.own[level].append(menu_json.dumps(own))
+            self.children[level].extend(children or (0, 0, 0))
+
+        self.spans[level].extend((start, len(self.menu)))
+
+def _joined(values):
+    # The values one after another, and where each starts (plus the end)
+    starts = array('Q', [0])
+    for value in values:
+        starts.append(starts[-1] + len(value))
+    return b''.join(values), starts
+
+def build_generation(data, version):
+    builder = GenerationBuilder()
+    root = builder.write_root(data)
+    sections = [('menu', bytes(builder.menu), 'B')]
+
+    for level in LEVELS:
+        names, name_starts = _joined([name.encode('utf-8') + b'\0' for name in builder.names[level]])
+        sections += [(f'{level}.spans', builder.spans[level], 'Q'),
+                     (f'{level}.names', names, 'B'),
+                     (f'{level}.name_starts', name_starts, 'Q')]
+        if level in builder.own:
+            own, own_starts = _joined(builder.own[level])
+            sections += [(f'{level}.own', own, 'B'), (f'{level}.own_starts', own_starts, 'Q'),
+                         (f'{level}.children', builder.children[level], 'I')]
+        if level in builder.parent:
+            sections.append((f'{level}.parent', builder.parent[level], 'I'))
+
+    items = builder.items
+    for level, parents in builder.ancestors.items():
+        sections.append((f'items.ancestors.{level}', parents, 'I'))
+
+    prices = menu_index.PriceIndex(items)
+    sections += [('items.price_values', prices.prices, 'd'),
+                 ('items.price_positions', prices.positions, 'I'),
+                 ('items.unpriced', prices.unpriced, 'I')]
+
+    # The same facets as menu_index.FacetIndex, as sorted item positions
+    tags = {}
+    any_dietary = array('I')
+    reward = {True: array('I'), False: array('I')}
+    ids = []
+    for position, item in enumerate(items):
+        item_tags = [tag for tag in item.get('dietary', []) if isinstance(tag, str)]
+        if item.get('dietary'):
+            any_dietary.append(position)
+        for tag in dict.fromkeys(item_tags):
+            tags.setdefault(tag, array('I')).append(position)
+        if item.get('rewardEligible') in reward:
+            reward[item['rewardEligible']].append(position)
+        if isinstance(item.get('id'), str):
+            ids.append((item['id'].encode('utf-8'), position))
+    tag_names = list(tags)
+    sections += [(f'items.dietary.{n}', tags[tag], 'I') for n, tag in enumerate(tag_names)]
+    sections += [('items.any_dietary', any_dietary, 'I'),
+                 ('items.reward.true', reward[True], 'I'),
+                 ('items.reward.false', reward[False], 'I')]
+
+    ids.sort()
+    id_values, id_starts = _joined([item_id for item_id, position in ids])
+    sections += [('items.ids', id_values, 'B'), ('items.id_starts', id_starts, 'Q'),
+                 ('items.id_positions', array('I', [position for item_id, position in ids]), 'I')]
+
+    header = {
+        'version': version,
+        'byteorder': sys.byteorder,
+        'counts': {level: len(builder.names[level]) for level in LEVELS},
+        'root': root,
+        'restaurant_names': [restaurant.get('name') for restaurant in data.get('restaurants', [])],
+        'field_names': sorted(builder.field_names),
+        'tags': tag_names,
+        'sections': {},
+    }
+
+    body = bytearray(MAGIC)
+    for name, values, typecode in sections:
+        # Arrays start on an 8 byte boundary, so they can be cast in place
+        body += bytes(-len(body) % 8)
+        values = values.tobytes() if isinstance(values, array) else values
+        header['sections'][name] = [len(body), len(values), typecode]
+        body += values
+
+    encoded_header = json.dumps(header).encode('utf-8')
+    header_offset = len(body)
+    body += encoded_header
+    body += struct.pack('<QQ', header_offset, len(encoded_header)) + MAGIC
+    return bytes(body)
+
+class Generation:
+    # A mapped generation file. Sections are read in place, nothing is copied
+    # until a node is parsed.
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        trailer = len(self.map) - 16 - len(MAGIC)
+        header_offset, header_length = struct.unpack_from('<QQ', self.map, trailer)
+        if self.map[:len(MAGIC)] != MAGIC or self.map[trailer + 16:] != MAGIC:
+            raise ValueError(f'{path} is not a menu generation')
+
+        self.header = json.loads(self.map[header_offset:header_offset + header_length])
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path} was written on a {self.header["byteorder"]} endian machine')
+        self.counts = self.header['counts']
+        self._view = memoryview(self.map)
+        self._arrays = {}
+
+    def bounds(self, name):
+        offset, length, typecode = self.header['sections'][name]
+        return offset, offset + length
+
+    def array(self, name):
+        try:
+            return self._arrays[name]
+        except KeyError:
+            offset, length, typecode = self.header['sections'][name]
+            return self._arrays.setdefault(name, self._view[offset:offset + length].cast(typecode))
+
+    def slice(self, name, start, end):
+        offset = self.header['sections'][name][0]
+        return self.map[offset + start:offset + end]
+
+    def menu_bytes(self):
+        start, end = self.bounds('menu')
+        return self.map[start:end]
+
+    def node_bytes(self, level, position):
+        spans = self.array(f'{level}.spans')
+        return self.slice('menu', spans[2 * position], spans[2 * position + 1])
+
+    def load_node(self, level, position, child):
+        # child(level, position) gives the parsed child nodes, so every node
+        # is parsed once however it is reached
+        child_level = CHILD_LEVEL[level]
+        if child_level is None:
+            return menu_json.load_menu(self.node_bytes(level, position))
+
+        starts = self.array(f'{level}.own_starts')
+        node = menu_json.load_menu(self.slice(f'{level}.own', starts[position], starts[position + 1]))
+        first, end, has_list = self.array(f'{level}.children')[3 * position:3 * position + 3]
+        if has_list:
+            node[child_level] = [child(child_level, n) for n in range(first, end)]
+        return node
+
+    def path(self, level, position):
+        # The path of a node in the menu, e.g. ['restaurants', 0, 'menus', 1]
+        path = []
+        depth = LEVELS.index(level)
+        while depth > 0:
+            parent_level = LEVELS[depth - 1]
+            parent = self.array(f'{level}.parent')[position]
+            path[:0] = [level, position - self.array(f'{parent_level}.children')[3 * parent]]
+            level, position, depth = parent_level, parent, depth - 1
+        return [level, position] + path
+
+class Nodes:
+    # The nodes of one level, in tree order, parsed when they are first used
+    def __init__(self, snapshot, level):
+        self.snapshot = snapshot
+        self.level = level
+        self._parsed = snapshot._nodes[level]
+
+    def __len__(self):
+        return len(self._parsed)
+
+    def __getitem__(self, position):
+        if position < 0:
+            raise IndexError(position)
+        node = self._parsed[position]
+        if node is None:
+            node = self.snapshot.node(self.level, position)
+        return node
+
+class Names:
+    # The lowercased names of one level
+    def __init__(self, generation, level):
+        self.generation = generation
+        self.level = level
+        self.starts = generation.array(f'{level}.name_starts')
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, position):
+        return self.generation.slice(f'{self.level}.names', self.starts[position], self.starts[position + 1] - 1).decode('utf-8')
+
+class SharedNameIndex:
+    # menu_index.NameIndex over the mapped names, which are searched in place
+    def __init__(self, snapshot, level):
+        self.nodes = Nodes(snapshot, level)
+        self.names = Names(snapshot.generation, level)
+        self._generation = snapshot.generation
+        self._level = level
+
+    def positions(self, search_name):
+        if search_name == '*':
+            return list(range(len(self.nodes)))
+
+        query = search_name.lower().encode('utf-8')
+        if b'\0' in query:
+            return []
+        start, end = self._generation.bounds(f'{self._level}.names')
+        starts = self.names.starts
+        positions = []
+        found = self._generation.map.find(query, start, end)
+        while found != -1:
+            position = bisect_right(starts, found - start) - 1
+            positions.append(position)
+            # Carry on from the next name, one match per name is enough
+            found = self._generation.map.find(query, start + starts[position + 1], end)
+        return positions
+
+    def estimate(self, search_name):
+        # Scanning the mapped names is cheap enough to count exactly
+        return len(self.positions(search_name))
+
+    def search(self, search_name):
+        return [self.nodes[position] for position in self.positions(search_name)]
+
+class SharedFacetIndex:
+    # menu_index.FacetIndex, with the bitsets built from the mapped positions
+    # the first time each facet is asked for
+    def __init__(self, snapshot):
+        self.items = Nodes(snapshot, ITEMS)
+        self.all = (1 << len(self.items)) - 1
+        self._generation = snapshot.generation
+        self._tags = {tag: n for n, tag in enumerate(self._generation.header['tags'])}
+        self._bits = {}
+        self._lock = threading.Lock()
+
+    def _section_bits(self, name):
+        with self._lock:
+            if name not in self._bits:
+                self._bits[name] = menu_index._bitmap(self._generation.array(name), len(self.items))
+            return self._bits[name]
+
+    def dietary_bits(self, requirement):
+        if requirement == '*':
+            return self._section_bits('items.any_dietary')
+        if requirement not in self._tags:
+            return 0
+        return self._section_bits(f'items.dietary.{self._tags[requirement]}')
+
+    def reward_bits(self, eligible):
+        return self._section_bits('items.reward.true' if eligible else 'items.reward.false')
+
+    def select(self, bits):
+        return [self.items[position] for position, bit in enumerate(bin(bits)[:1:-1]) if bit == '1']
+
+class SharedPriceIndex(menu_index.PriceIndex):
+    # menu_index.PriceIndex over the mapped arrays
+    def __init__(self, generation):
+        self.prices = generation.array('items.price_values')
+        self.positions = generation.array('items.price_positions')
+        self.unpriced = generation.array('items.unpriced')
+
+class SharedAncestorIndex:
+    def __init__(self, generation):
+        self.parents = {level: generation.array(f'items.ancestors.{level}') for level in LEVELS[:-1]}
+
+class SharedIdIndex:
+    # The id -> [(item, path)] mapping of menu_index.build_id_index, looked up
+    # with a binary search of the sorted ids
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._generation = snapshot.generation
+        self._starts = self._generation.array('items.id_starts')
+        self._positions = self._generation.array('items.id_positions')
+
+    def _id(self, n):
+        return self._generation.slice('items.ids', self._starts[n], self._starts[n + 1])
+
+    def get(self, item_id, default=None):
+        if not isinstance(item_id, str):
+            return default
+        key = item_id.encode('utf-8')
+        low, high = 0, len(self._positions)
+        while low < high:
+            middle = (low + high) // 2
+            if self._id(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        positions = []
+        while low < len(self._positions) and self._id(low) == key:
+            positions.append(self._positions[low])
+            low += 1
+        if not positions:
+            return default
+        return [(self._snapshot.node(ITEMS, position), self._generation.path(ITEMS, position)) for position in sorted(positions)]
+
+# Derived values answered from the generation rather than built from the tree
+SHARED_DERIVED = {
+    'payload': lambda snapshot: menu_payload.MenuPayload(snapshot.generation.menu_bytes()),
+    'names': lambda snapshot: {level: SharedNameIndex(snapshot, level) for level in LEVELS},
+    'facets': SharedFacetIndex,
+    'ancestors': lambda snapshot: SharedAncestorIndex(snapshot.generation),
+    'prices': lambda snapshot: SharedPriceIndex(snapshot.generation),
+    'ids': SharedIdIndex,
+    'field_names': lambda snapshot: set(snapshot.generation.header['field_names']),
+}
+
+class SharedSnapshot(menu_cache.MenuSnapshot):
+    def __init__(self, path, generation, signature, data=None):
+        super().__init__(path, None, signature, generation.header['version'])
+        self.generation = generation
+        # Parsed nodes by level and position, None until first used
+        self._nodes = {level: [None] * generation.counts[level] for level in LEVELS}
+        if data is not None:
+            # The tree the generation was written from, which the worker that
+            # wrote it already has
+            positions = dict.fromkeys(LEVELS, 0)
+            for level, node, path in menu_index.iter_nodes(data):
+                self._nodes[level][positions[level]] = node
+                positions[level] += 1
+            self._data = data
+
+    @property
+    def data(self):
+        if self._data is None:
+            with self._derived_lock:
+                if self._data is None:
+                    self._data = dict(self.menu_root(), restaurants=[self.node('restaurants', n) for n in range(self.generation.counts['restaurants'])])
+        return self._data
+
+    def node(self, level, position):
+        node = self._nodes[level][position]
+        if node is not None:
+            return node
+
+        with self._derived_lock:
+            if self._nodes[level][position] is None:
+                self._nodes[level][position] = self.generation.load_node(level, position, self.node)
+            return self._nodes[level][position]
+
+    def menu_root(self):
+        return self.generation.header['root']
+
+    def restaurants_named(self, name):
+        return [self.node('restaurants', n) for n, restaurant_name in enumerate(self.generation.header['restaurant_names']) if restaurant_name == name]
+
+    def restaurant_at(self, position):
+        return self.node('restaurants', position) if 0 <= position < self.generation.counts['restaurants'] else None
+
+    def derived(self, key, build):
+        if key in SHARED_DERIVED:
+            return self.cached(key, lambda: SHARED_DERIVED[key](self))
+        return super().derived(key, build)
+
+class SharedStorage:
+    # The generation directory is filled from the menu file the first time
+    # the storage is used, after that the menu file is no longer read. The
+    # version is kept in each generation, so every worker agrees on it, but
+    # a worker only knows the operations it applied itself: changes made by
+    # another worker make the change feed ask clients to resync.
+
+    def __init__(self, path, directory=None, changes_kept=1000):
+        self.path = path
+        self.directory = directory or shared_directory(path)
+        self.current_path = os.path.join(self.directory, CURRENT)
+        self.changes = menu_storage.ChangeLog(changes_kept)
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._current_signature = None
+
+    def _current_stat(self):
+        try:
+            return menu_cache.file_signature(self.current_path)
+        except FileNotFoundError:
+            return None
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is not None and self._current_stat() == self._current_signature:
+            return snapshot
+
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self, data=None):
+        if not os.path.exists(self.current_path):
+            self.publish_menu()
+
+        with open(self.current_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            signature = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+            if self._snapshot is not None and signature == self._current_signature:
+                return self._snapshot
+            name = f.read().decode('utf-8').strip()
+
+        generation = Generation(os.path.join(self.directory, name))
+        version = generation.header['version']
+        if self._snapshot is None or version != self.changes.version:
+            self.changes.reset(version)
+        self._current_signature = signature
+        self._snapshot = SharedSnapshot(self.path, generation, ('shared', name), data)
+        return self._snapshot
+
+    def publish_menu(self):
+        with self._lock, menu_storage.file_lock(self.path):
+            if os.path.exists(self.current_path):
+                return
+
+            with open(self.path, 'rb') as f:
+                data = menu_json.load_menu(f.read())
+            os.makedirs(self.directory, exist_ok=True)
+            self._publish(data, 0)
+
+    def _publish(self, data, version):
+        name = f'{uuid.uuid4().hex}.menu'
+        menu_cache.write_bytes_atomic(os.path.join(self.directory, name), build_generation(data, version))
+        try:
+            with open(self.current_path, 'rb') as f:
+                previous = f.read().decode('utf-8').strip()
+        except FileNotFoundError:
+            previous = None
+        # Workers move to the new generation once current names it
+        menu_cache.write_bytes_atomic(self.current_path, name.encode('utf-8'))
+        if previous:
+            # The time a generation stops being current is when its grace period starts
+            os.utime(os.path.join(self.directory, previous))
+        self._remove_unused_generations(name)
+
+    def _remove_unused_generations(self, current):
+        cutoff = time.time() - UNUSED_GENERATION_SECONDS
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.menu') and name != current and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+
+    def commit(self, operations, if_version=None):
+        # publish_menu takes the file lock itself, so the first generation is made first
+        self.snapshot()
+        with self._lock, menu_storage.file_lock(self.path):
+            current = self.snapshot()
+            menu_storage.check_version(current.version, if_version)
+            data = menu_storage.apply_operations(current.data, operations)
+            self._publish(data, current.version + len(operations))
+
+            for operation in operations:
+                self.changes.record(self.changes.version + 1, operation)
+            return self._refresh(data)
+
+    def changes_since(self, version):
+        with self._lock:
+            self.snapshot()
+            return self.changes.version, self.changes.since(version)
+
+menu_storage.STORAGE_TYPES['shared'] = SharedStorage
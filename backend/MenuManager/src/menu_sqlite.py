@@ -0,0 +1,355 @@
+import os
+import sqlite3
+import sys
+import threading
+import menu_cache
+import menu_json
+import menu_storage
+from menu_index import LEVELS, CHILD_LEVEL
+
+# Stores the menu in SQLite, one table per level of the tree. Each row keeps
+# the node's own fields as JSON (with its child list left as a null
+# placeholder so the key order is kept), plus plain copies of names, item
+# ids, prices, reward eligibility and dietary tags for reading the database
+# directly. Commits only touch the rows of the nodes an operation changes.
+#
+# Searches are answered from the in-memory indexes built from each worker's
+# copy of the tree, as with the other storages, so the only indexes kept are
+# the ones commits use to find rows. A read transaction per snapshot would
+# be needed to search the tables instead, and one held by an idle worker
+# stops the write-ahead log from ever being reset.
+#
+# Every operation bumps the version stored in the meta table and is kept in
+# the changes table, so other workers can catch up by replaying the changes
+# instead of reloading the whole menu.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS changes (version INTEGER PRIMARY KEY, operation TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS restaurants (
+    id INTEGER PRIMARY KEY, parent_id INTEGER, position INTEGER NOT NULL, name TEXT, fields TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS menus (
+    id INTEGER PRIMARY KEY, parent_id INTEGER NOT NULL REFERENCES restaurants(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL, name TEXT, fields TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY, parent_id INTEGER NOT NULL REFERENCES menus(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL, name TEXT, fields TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY, parent_id INTEGER NOT NULL REFERENCES categories(id) ON DELETE CASCADE,
+    position INTEGER NOT NULL, name TEXT, item_id TEXT, price REAL, reward_eligible INTEGER, fields TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS dietary (
+    item INTEGER NOT NULL REFERENCES items(id) ON DELETE CASCADE, tag TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS restaurants_position ON restaurants (parent_id, position);
+CREATE INDEX IF NOT EXISTS menus_position ON menus (parent_id, position);
+CREATE INDEX IF NOT EXISTS categories_position ON categories (parent_id, position);
+CREATE INDEX IF NOT EXISTS items_position ON items (parent_id, position);
+CREATE INDEX IF NOT EXISTS dietary_item ON dietary (item);
+'''
+
+def connect(database):
+    connection = sqlite3.connect(database, check_same_thread=False, isolation_level=None)
+    connection.execute('PRAGMA foreign_keys = ON')
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.executescript(SCHEMA)
+    return connection
+
+def _text(value):
+    return value if isinstance(value, str) else None
+
+def _row_fields(level, node):
+    fields = dict(node)
+    child_level = CHILD_LEVEL[level]
+    if child_level in fields:
+        fields[child_level] = None
+    return menu_json.dumps(fields).decode('utf-8')
+
+def _insert_node(connection, level, parent_id, position, node):
+    if not isinstance(node, dict):
+        raise TypeError(f'{level} entries must be objects')
+
+    if level == 'items':
+        price = node.get('price')
+        reward = node.get('rewardEligible')
+        cursor = connection.execute(
+            'INSERT INTO items (parent_id, position, name, item_id, price, reward_eligible, fields) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (parent_id, position, _text(node.get('name')), _text(node.get('id')),
+             price if isinstance(price, (int, float)) else None,
+             int(reward) if isinstance(reward, bool) else None, _row_fields(level, node)))
+        _insert_dietary(connection, cursor.lastrowid, node)
+        return cursor.lastrowid
+
+    cursor = connection.execute(
+        f'INSERT INTO {level} (parent_id, position, name, fields) VALUES (?, ?, ?, ?)',
+        (parent_id, position, _text(node.get('name')), _row_fields(level, node)))
+    row_id = cursor.lastrowid
+
+    child_level = CHILD_LEVEL[level]
+    children = node.get(child_level)
+    if isinstance(children, list):
+        for child_position, child in enumerate(children):
+            _insert_node(connection, child_level, row_id, child_position, child)
+    return row_id
+
+def _insert_dietary(connection, row_id, node):
+    tags = node.get('dietary')
+    if isinstance(tags, list):
+        connection.executemany('INSERT INTO dietary (item, tag) VALUES (?, ?)',
+                               [(row_id, tag) for tag in tags if isinstance(tag, str)])
+
+def _update_node(connection, level, row_id, node):
+    if level == 'items':
+        price = node.get('price')
+        reward = node.get('rewardEligible')
+        connection.execute(
+            'UPDATE items SET name = ?, item_id = ?, price = ?, reward_eligible = ?, fields = ? WHERE id = ?',
+            (_text(node.get('name')), _text(node.get('id')),
+             price if isinstance(price, (int, float)) else None,
+             int(reward) if isinstance(reward, bool) else None, _row_fields(level, node), row_id))
+        connection.execute('DELETE FROM dietary WHERE item = ?', (row_id,))
+        _insert_dietary(connection, row_id, node)
+    else:
+        connection.execute(f'UPDATE {level} SET name = ?, fields = ? WHERE id = ?',
+                           (_text(node.get('name')), _row_fields(level, node), row_id))
+
+def _delete_node(connection, level, parent_id, position, row_id):
+    connection.execute(f'DELETE FROM {level} WHERE id = ?', (row_id,))
+    connection.execute(f'UPDATE {level} SET position = position - 1 WHERE parent_id IS ? AND position > ?',
+                       (parent_id, position))
+
+def _row_id(connection, level, parent_id, position):
+    row = connection.execute(f'SELECT id FROM {level} WHERE parent_id IS ? AND position = ?',
+                             (parent_id, position)).fetchone()
+    if row is None:
+        raise IndexError(f'{level} {position} does not exist')
+    return row[0]
+
+def _replace_node(connection, level, parent_id, position, row_id, node):
+    connection.execute(f'DELETE FROM {level} WHERE id = ?', (row_id,))
+    _insert_node(connection, level, parent_id, position, node)
+
+def _write_restaurants(connection, data):
+    connection.execute('DELETE FROM restaurants')
+    for position, restaurant in enumerate(data.get('restaurants', [])):
+        _insert_node(connection, 'restaurants', None, position, restaurant)
+
+def _write_root(connection, data):
+    # Anything at the top of the document other than the restaurants
+    root = dict(data)
+    root['restaurants'] = None
+    connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('root', ?)", (menu_json.dumps(root).decode('utf-8'),))
+
+def write_operation(connection, old_data, new_data, operation):
+    # Walks the operation's path down the levels of the tree to find the node
+    # it changed, then rewrites only that node's rows. old_data and new_data
+    # are the trees before and after the operation was applied.
+    path = operation['path']
+    op = operation['op']
+
+    old_node, new_node = old_data, new_data
+    level = row_id = parent_id = position = None
+    depth = 0
+    while (depth < len(LEVELS) and len(path) > depth * 2 + 1
+           and path[depth * 2] == LEVELS[depth] and isinstance(path[depth * 2 + 1], int)):
+        level = LEVELS[depth]
+        old_list = old_node[level]
+        position = path[depth * 2 + 1]
+        if position < 0:
+            position += len(old_list)
+
+        parent_id = row_id
+        row_id = _row_id(connection, level, parent_id, position)
+        old_node = old_list[position]
+        depth += 1
+        if op != 'delete' or len(path) > depth * 2:
+            new_node = new_node[level][position]
+
+    rest = path[depth * 2:]
+    child_level = LEVELS[depth] if depth < len(LEVELS) else None
+
+    if not rest:
+        if op == 'delete':
+            _delete_node(connection, level, parent_id, position, row_id)
+        else:
+            _replace_node(connection, level, parent_id, position, row_id, new_node)
+    elif child_level is not None and rest == [child_level] and op == 'add':
+        _insert_node(connection, child_level, row_id, len(old_node[child_level]), new_node[child_level][-1])
+    elif child_level is not None and rest[0] == child_level:
+        # Anything else done to a child list replaces the node that owns it
+        if level is None:
+            _write_restaurants(connection, new_data)
+        else:
+            _replace_node(connection, level, parent_id, position, row_id, new_node)
+    elif level is None:
+        _write_root(connection, new_data)
+    else:
+        _update_node(connection, level, row_id, new_node)
+
+def get_version(connection):
+    row = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    return int(row[0]) if row else None
+
+def _set_version(connection, version):
+    connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)", (str(version),))
+
+def load_menu(connection):
+    # Builds the tree bottom up, so each level's rows only need to be read once
+    children = {}
+    for level in reversed(LEVELS):
+        child_level = CHILD_LEVEL[level]
+        nodes = {}
+        for row_id, parent_id, fields in connection.execute(
+                f'SELECT id, parent_id, fields FROM {level} ORDER BY parent_id, position'):
+            node = menu_json.load_menu(fields)
+            if child_level is not None and child_level in node:
+                node[child_level] = children.get(row_id, [])
+            nodes.setdefault(parent_id, []).append(node)
+        children = nodes
+
+    row = connection.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+    root = menu_json.load_menu(row[0]) if row else {'restaurants': None}
+    root['restaurants'] = children.get(None, [])
+    return root
+
+def import_menu(connection, json_path, replace=True):
+    # Without replace the menu is only imported into an empty database, so a
+    # worker opening it for the first time never overwrites commits another
+    # worker made after filling it
+    with open(json_path, 'rb') as f:
+        data = menu_json.load_menu(f.read())
+
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        version = get_version(connection)
+        if version is not None and not replace:
+            connection.execute('COMMIT')
+            return
+        for table in ['dietary', 'items', 'categories', 'menus', 'restaurants', 'changes']:
+            connection.execute(f'DELETE FROM {table}')
+        _write_restaurants(connection, data)
+        _write_root(connection, data)
+        # The import is not a change clients could replay, so anyone holding an
+        # older version has to resync
+        _set_version(connection, 0 if version is None else version + 1)
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+
+class SqliteStorage:
+    # The database defaults to a file next to the menu file. It is filled from
+    # the menu file the first time it is opened, after that the menu file is
+    # no longer read.
+
+    def __init__(self, path, database=None, changes_kept=1000):
+        self.path = path
+        self.database = database or os.path.splitext(path)[0] + '.sqlite3'
+        self.changes_kept = changes_kept
+        self.changes = menu_storage.ChangeLog(changes_kept)
+        self._lock = threading.RLock()
+        self._connection = None
+        self._data_version = None
+        self._snapshot = None
+
+    def _connect(self):
+        if self._connection is None:
+            connection = connect(self.database)
+            if get_version(connection) is None:
+                import_menu(connection, self.path, replace=False)
+            self._connection = connection
+        return self._connection
+
+    def _new_snapshot(self, data):
+        return menu_cache.new_snapshot(self.path, data, ('sqlite', self.database, self.changes.version), self.changes.version)
+
+    def snapshot(self):
+        with self._lock:
+            connection = self._connect()
+
+            # data_version only changes when another connection commits
+            data_version = connection.execute('PRAGMA data_version').fetchone()[0]
+            if self._snapshot is not None and data_version == self._data_version:
+                return self._snapshot
+            self._data_version = data_version
+
+            version = get_version(connection)
+            if self._snapshot is not None and version == self.changes.version:
+                return self._snapshot
+
+            if self._snapshot is not None and version > self.changes.version:
+                rows = connection.execute('SELECT version, operation FROM changes WHERE version > ? ORDER BY version',
+                                          (self.changes.version,)).fetchall()
+                if rows and rows[0][0] == self.changes.version + 1 and rows[-1][0] == version:
+                    data = self._snapshot.data
+                    for change_version, operation in rows:
+                        operation = menu_json.load_menu(operation)
+                        data = menu_storage.apply_operation(data, operation)
+                        self.changes.record(change_version, operation)
+                    self._snapshot = self._new_snapshot(data)
+                    return self._snapshot
+
+            data = load_menu(connection)
+            self._load_changes(connection, version)
+            self._snapshot = self._new_snapshot(data)
+            return self._snapshot
+
+    def _load_changes(self, connection, version):
+        rows = connection.execute('SELECT version, operation FROM changes WHERE version > ? ORDER BY version',
+                                  (version - self.changes_kept,)).fetchall()
+        if rows and rows[-1][0] == version:
+            self.changes.reset(rows[0][0] - 1)
+            for change_version, operation in rows:
+                self.changes.record(change_version, menu_json.load_menu(operation))
+        else:
+            self.changes.reset(version)
+
+    def commit(self, operations, if_version=None):
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                # Refreshed inside the write transaction, so it includes every
+                # commit made by other workers
+                current = self.snapshot()
+                menu_storage.check_version(current.version, if_version)
+                data = current.data
+                version = self.changes.version
+                for operation in operations:
+                    new_data = menu_storage.apply_operation(data, operation)
+                    write_operation(connection, data, new_data, operation)
+                    data = new_data
+                    version += 1
+                    connection.execute('INSERT INTO changes (version, operation) VALUES (?, ?)',
+                                       (version, menu_json.dumps(operation).decode('utf-8')))
+                _set_version(connection, version)
+                connection.execute('DELETE FROM changes WHERE version <= ?', (version - self.changes_kept,))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+            for change_version, operation in enumerate(operations, self.changes.version + 1):
+                self.changes.record(change_version, operation)
+            self._snapshot = self._new_snapshot(data)
+            return self._snapshot
+
+    def changes_since(self, version):
+        with self._lock:
+            self.snapshot()
+            return self.changes.version, self.changes.since(version)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+            self._connection = None
+            self._data_version = None
+            self._snapshot = None
+
+menu_storage.STORAGE_TYPES['sqlite'] = SqliteStorage
+
+if __name__ == '__main__':
+    # python menu_sqlite.py menus.json [menus.sqlite3]
+    json_path = sys.argv[1]
+    database = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(json_path)[0] + '.sqlite3'
+    import_menu(connect(database), json_path)
+    print(f'Imported {json_path} into {database}')
@@ -0,0 +1,392 @@
+import json
+import math
+import os
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager
+import menu_cache
+import menu_json
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Changes to the menu are described as operations:
+#   {'op': 'add', 'path': [...], 'value': ...}     append value to the list at path
+#   {'op': 'update', 'path': [...], 'value': ...}  replace the value at path
+#   {'op': 'delete', 'path': [...]}                remove the value at path
+#
+# Operations never change the tree they are given. Only the containers along
+# the path are copied, everything else is shared with the previous snapshot,
+# so applying an operation costs O(depth) rather than O(menu size).
+
+ITEMS = 'items'
+
+def _copy(node):
+    if isinstance(node, dict):
+        return dict(node)
+    if isinstance(node, list):
+        return list(node)
+    return node
+
+def _copy_path(data, keys):
+    root = _copy(data)
+    target = root
+    for key in keys:
+        child = _copy(target[key])
+        target[key] = child
+        target = child
+    return root, target
+
+def apply_operation(data, operation):
+    op = operation['op']
+    path = operation['path']
+
+    if op == 'add':
+        root, target = _copy_path(data, path)
+        target.append(operation['value'])
+    elif op == 'update':
+        root, target = _copy_path(data, path[:-1])
+        new_data = operation['value']
+        if len(path) > 1 and path[-2] == ITEMS:
+            item = dict(target[path[-1]])
+            item['name'] = new_data['name']
+            item['price'] = float(new_data['price'])
+            if not math.isfinite(item['price']):
+                raise ValueError('price must be a finite number')
+            item['rewardEligible'] = new_data['rewardEligible']
+            target[path[-1]] = item
+        else:
+            target[path[-1]] = new_data
+    elif op == 'delete':
+        root, target = _copy_path(data, path[:-1])
+        del target[path[-1]]
+    else:
+        raise ValueError(f'Unknown operation {op}')
+
+    return root
+
+def apply_operations(data, operations):
+    for operation in operations:
+        data = apply_operation(data, operation)
+    return data
+
+class VersionConflict(Exception):
+    def __init__(self, version):
+        super().__init__(f'The menu is at version {version}')
+        self.version = version
+
+def check_version(version, if_version):
+    # if_version is the set of versions a change was based on, None to apply
+    # it whatever the current version is
+    if if_version is not None and version not in if_version:
+        raise VersionConflict(version)
+
+@contextmanager
+def file_lock(path):
+    # Held by a process while it writes the menu, so writes from different
+    # workers are applied one after another. Readers never take it, they only
+    # ever see complete files swapped into place by write_atomic. Without
+    # fcntl (Windows) only threads of the same process are kept apart.
+    if fcntl is None:
+        yield
+        return
+
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class ChangeLog:
+    # The most recent operations, each tagged with the menu version it
+    # produced. Versions go up by one per operation. reset() marks a change
+    # whose operations are not known (the file was replaced some other way),
+    # so clients older than that have to download the whole menu again.
+
+    # Listeners are called with each change as it is recorded (or with
+    # {'version': ..., 'resync': True} on a reset) while the storage lock is
+    # held, so they must not block.
+
+    def __init__(self, size=1000):
+        self.version = 0
+        self.changes = deque(maxlen=size)
+        self.listeners = []
+
+    def record(self, version, operation):
+        change = dict(operation, version=version)
+        self.changes.append(change)
+        self.version = version
+        for listener in self.listeners:
+            listener(change)
+
+    def reset(self, version):
+        self.changes.clear()
+        self.version = version
+        for listener in self.listeners:
+            listener({'version': version, 'resync': True})
+
+    def since(self, version):
+        oldest = self.changes[0]['version'] - 1 if self.changes else self.version
+        if version < oldest or version > self.version:
+            return None
+        return [change for change in self.changes if change['version'] > version]
+
+# Versions of storages that count them in each worker start at a random
+# point, far enough apart that one worker's versions never reach another's
+VERSION_START_BITS = 32
+VERSION_START_STEP = 2 ** 20
+
+def worker_version_start():
+    return random.SystemRandom().getrandbits(VERSION_START_BITS) * VERSION_START_STEP
+
+class JsonFileStorage:
+    # The whole menu lives in one JSON file that is rewritten on every commit.
+    # Menu versions are counted by this process, so the change log only holds
+    # changes made through this worker. Each worker starts counting at its
+    # own random version, so a version handed out by another worker never
+    # matches one here: If-Match with it is refused and the change feed asks
+    # for a resync, rather than either being checked against a different menu.
+
+    def __init__(self, path, changes_kept=1000, warm_start=False):
+        self.path = path
+        self.warm_start = warm_start
+        self.changes = ChangeLog(changes_kept)
+        self.changes.version = worker_version_start()
+        self._lock = threading.RLock()
+        self._base = None
+        self._snapshot = None
+
+    def snapshot(self):
+        base = menu_cache.get_snapshot(self.path, self.warm_start)
+        if base is self._base:
+            return self._snapshot
+
+        with self._lock:
+            if base is not self._base:
+                if self._base is not None:
+                    # The file was changed by something other than this storage
+                    self.changes.reset(self.changes.version + 1)
+                self._base = base
+                self._snapshot = menu_cache.new_snapshot(self.path, base.data, base.signature, self.changes.version, shared=base)
+            return self._snapshot
+
+    def commit(self, operations, if_version=None):
+        with self._lock, file_lock(self.path):
+            # Read again under the lock, so changes made by other workers are
+            # built on rather than overwritten
+            current = self.snapshot()
+            check_version(current.version, if_version)
+            data = apply_operations(current.data, operations)
+            base = menu_cache.store_menu(self.path, data, self.warm_start)
+            for operation in operations:
+                self.changes.record(self.changes.version + 1, operation)
+            self._base = base
+            self._snapshot = menu_cache.new_snapshot(self.path, data, base.signature, self.changes.version, shared=base)
+            return self._snapshot
+
+    def changes_since(self, version):
+        with self._lock:
+            self.snapshot()
+            return self.changes.version, self.changes.since(version)
+
+class JournaledStorage:
+    # The menu file is treated as a base snapshot and every commit appends its
+    # operations to a journal file next to it (one JSON record per line).
+    # Readers replay the journal on top of the cached base, only reading the
+    # records they have not seen yet. Once the journal gets long it is
+    # compacted in the background: the current tree is written over the base
+    # file and the journal is started again.
+    #
+    # The first line of the journal records the signature of the base file it
+    # applies to and the menu version it starts from. If the base file changes
+    # underneath it (a compaction, or an edit made by hand) the old journal no
+    # longer applies and is ignored. Records carry the version they produce,
+    # so every worker reading the journal agrees on the menu version.
+
+    def __init__(self, path, compact_after=100, changes_kept=1000, warm_start=False):
+        self.path = path
+        self.warm_start = warm_start
+        self.journal_path = path + '.journal'
+        self.compact_after = compact_after
+        self.changes = ChangeLog(changes_kept)
+        self._lock = threading.RLock()
+        self._snapshot = None
+        self._base_signature = None
+        self._journal_signature = None
+        self._offset = 0
+        self._records = 0
+        self._compacting = False
+
+    def _journal_stat(self):
+        try:
+            stat = os.stat(self.journal_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+
+    def snapshot(self):
+        base = menu_cache.get_snapshot(self.path, self.warm_start)
+        journal = self._journal_stat()
+        snapshot = self._snapshot
+        if snapshot is not None and self._base_signature == base.signature and self._journal_signature == journal:
+            return snapshot
+
+        with self._lock:
+            return self._refresh(base, journal)
+
+    def _refresh(self, base, journal):
+        if self._snapshot is not None and self._base_signature == base.signature and self._journal_signature == journal:
+            return self._snapshot
+
+        grown = (self._snapshot is not None and journal is not None and self._journal_signature is not None
+                 and self._base_signature == base.signature
+                 and journal[1] == self._journal_signature[1] and journal[2] >= self._offset)
+
+        if grown:
+            data = self._snapshot.data
+        else:
+            data = base.data
+            self._offset = 0
+            self._records = 0
+
+        if journal is not None:
+            data = self._replay(data, base.signature)
+        elif self._snapshot is not None:
+            self.changes.reset(self.changes.version + 1)
+
+        self._base_signature = base.signature
+        self._journal_signature = journal
+        self._snapshot = self._new_snapshot(data, base if data is base.data else None)
+        return self._snapshot
+
+    def _new_snapshot(self, data, base=None):
+        return menu_cache.new_snapshot(self.path, data, (self._base_signature, self._journal_signature), self.changes.version, shared=base)
+
+    def _replay(self, data, base_signature):
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._offset)
+            chunk = f.read()
+
+        # Only complete lines are applied, a record that is still being
+        # written is picked up on a later read
+        end = chunk.rfind(b'\n') + 1
+        for line in chunk[:end].splitlines():
+            record = menu_json.load_menu(line)
+            if 'base' in record:
+                if tuple(record['base']) != base_signature:
+                    # The base was replaced (by a compaction in another
+                    # worker) and its journal is not started yet. The version
+                    # is kept until the new header says which one the base holds.
+                    self._offset += len(chunk)
+                    return data
+                if record['seq'] != self.changes.version:
+                    self.changes.reset(record['seq'])
+                continue
+            seq = record.pop('seq')
+            data = apply_operation(data, record)
+            self.changes.record(seq, record)
+            self._records += 1
+
+        self._offset += end
+        return data
+
+    def _header_matches(self, base_signature):
+        try:
+            with open(self.journal_path, 'rb') as f:
+                header = json.loads(f.readline())
+        except (FileNotFoundError, ValueError):
+            return False
+        return tuple(header.get('base', ())) == base_signature
+
+    def _start_journal(self, base_signature):
+        header = {'base': list(base_signature), 'seq': self.changes.version}
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps(header) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.journal_path)
+        self._offset = os.path.getsize(self.journal_path)
+        self._records = 0
+
+    def commit(self, operations, if_version=None):
+        with self._lock, file_lock(self.path):
+            current = self.snapshot()
+            check_version(current.version, if_version)
+            data = apply_operations(current.data, operations)
+
+            if not self._header_matches(self._base_signature):
+                self._start_journal(self._base_signature)
+
+            # Encoded the way they are read back, so a value that cannot be
+            # stored fails here rather than when the journal is replayed
+            lines = []
+            for seq, operation in enumerate(operations, self.changes.version + 1):
+                lines.append(menu_json.dumps(dict(operation, seq=seq)) + b'\n')
+
+            with open(self.journal_path, 'r+b') as f:
+                # Drop a partial record left behind by a write that never finished
+                f.truncate(self._offset)
+                f.seek(self._offset)
+                f.write(b''.join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+            for operation in operations:
+                self.changes.record(self.changes.version + 1, operation)
+            self._records += len(operations)
+            self._offset = os.path.getsize(self.journal_path)
+            self._journal_signature = self._journal_stat()
+            self._snapshot = self._new_snapshot(data)
+
+            if self._records >= self.compact_after and not self._compacting:
+                self._compacting = True
+                threading.Thread(target=self.compact, daemon=True).start()
+
+            return self._snapshot
+
+    def compact(self):
+        with self._lock, file_lock(self.path):
+            try:
+                snapshot = self.snapshot()
+                if self._records == 0:
+                    return snapshot
+
+                base = menu_cache.store_menu(self.path, snapshot.data, self.warm_start)
+                self._base_signature = base.signature
+                self._start_journal(base.signature)
+                self._journal_signature = self._journal_stat()
+                self._snapshot = self._new_snapshot(snapshot.data, base)
+                return self._snapshot
+            finally:
+                self._compacting = False
+
+    def changes_since(self, version):
+        with self._lock:
+            self.snapshot()
+            return self.changes.version, self.changes.since(version)
+
+STORAGE_TYPES = {
+    'json': JsonFileStorage,
+    'journal': JournaledStorage,
+}
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+def get_storage(kind, path, **options):
+    key = (kind, path)
+    storage = _storages.get(key)
+    if storage is None:
+        with _storages_lock:
+            storage = _storages.get(key)
+            if storage is None:
+                if kind not in STORAGE_TYPES:
+                    raise ValueError(f'Unknown menu storage {kind}')
+                storage = STORAGE_TYPES[kind](path, **options)
+                _storages[key] = storage
+    return storage
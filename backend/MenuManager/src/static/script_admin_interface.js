@@ -1,10 +1,23 @@
-function fetchData() {
+// The tree is fetched one level at a time through /api/get_data/node, so only
+// the restaurants, menus and categories that are opened are downloaded.
+// Opened nodes are remembered by path (e.g. "restaurants/0/menus/1") and
+// opened again whenever the level above them is reloaded.
+const expandedNodes = new Set();
+
+function nodeKey(path) {
+    return path.join('/');
+}
+
+function nodePath(key) {
+    return key.split('/').map(part => /^\d+$/.test(part) ? Number(part) : part);
+}
+
+function fetchNode(path, onLoad) {
     const xhttp = new XMLHttpRequest();
-    xhttp.open('GET', '/api/get_data', true);
+    xhttp.open('GET', `/api/get_data/node?path=${encodeURIComponent(nodeKey(path))}&depth=1&counts=true`, true);
     xhttp.onload = function () {
         if (xhttp.status === 200) {
-            const data = JSON.parse(xhttp.responseText);
-            renderData(data);
+            onLoad(JSON.parse(xhttp.responseText));
         } else {
             alert('Failed to fetch data');
         }
@@ -12,6 +25,10 @@ function fetchData() {
     xhttp.send();
 }
 
+function fetchData() {
+    fetchNode([], renderData);
+}
+
 function renderData(data) {
     const container = document.getElementById('restaurants-container');
     container.innerHTML = '';
@@ -25,45 +42,7 @@ function renderData(data) {
                 <input type="text" value="${restaurant.name}" id="restaurant-${restaurantIndex}">
                 <button onclick="updateRestaurant(${restaurantIndex})">Update Restaurant Name</button>
                 <button onclick="deleteRestaurant(${restaurantIndex})">Delete Restaurant</button>
-                ${restaurant.menus.map((menu, menuIndex) => `
-                    <div class="menu">
-                        <label for="menu-${restaurantIndex}-${menuIndex}">Menu:</label>
-                        <input type="text" value="${menu.name}" id="menu-${restaurantIndex}-${menuIndex}">
-                        <button onclick="updateMenu(${restaurantIndex}, ${menuIndex})">Update Menu Name</button>
-                        <button onclick="deleteMenu(${restaurantIndex}, ${menuIndex})">Delete Menu</button>
-                        ${menu.categories.map((category, categoryIndex) => `
-                            <div class="category">
-                                <label for="category-${restaurantIndex}-${menuIndex}-${categoryIndex}">Category:</label> 
-                                <input type="text" value="${category.name}" id="category-${restaurantIndex}-${menuIndex}-${categoryIndex}">
-                                <button onclick="updateCategory(${restaurantIndex}, ${menuIndex}, ${categoryIndex})">Update Category</button>
-                                <button onclick="deleteCategory(${restaurantIndex}, ${menuIndex}, ${categoryIndex})">Delete Category</button>
-                                ${category.items.map((item, itemIndex) => `
-                                    <div class="item">
-                                        <label for="item-name-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">Item:</label>
-                                        <input type="text" value="${item.name}" id="item-name-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">
-                                        <label for="item-price-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">Price: £</label>
-                                        <input type="number" step="0.01" value="${item.price}" placeholder="0.00" min="0.00" id="item-price-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">
-                                        ${item.dietary.map((dietary, dietaryIndex) => `
-                                            <div class="dietary">
-                                                <label for="item-dietary-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}-${dietaryIndex}">Dietary/Allergy Info:</label>
-                                                <input type="text" value="${dietary}" id="item-dietary-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}-${dietaryIndex}">
-                                                <button onclick="updateDietaryRequirement(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex}, ${dietaryIndex})">Update Dietary Requirement</button>
-                                                <button onclick="deleteDietaryRequirement(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex}, ${dietaryIndex})">Delete Dietary Requirement</button>
-                                            </div>
-                                        `).join('')}
-                                        <button onclick="addDietaryRequirement(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex})">Add Dietary Requirement</button>
-                                        <label for="item-reward-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">Reward Eligible:</label>
-                                        <input type="checkbox" id="item-reward-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">
-                                        <button onclick="updateItem(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex})">Update Item Details</button>
-                                        <button onclick="deleteItem(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex})">Delete Item</button>
-                                    </div>
-                                `).join('')}
-                                <button onclick="addItem(${restaurantIndex}, ${menuIndex}, ${categoryIndex})">Add Item</button>
-                            </div>
-                        `).join('')}
-                        <button onclick="addCategory(${restaurantIndex}, ${menuIndex})">Add Category</button>
-                    </div>
-                `).join('')}
+                ${renderToggle(['restaurants', restaurantIndex], 'Menus', restaurant.childCount)}
                 <button onclick="addMenu(${restaurantIndex})">Add Menu</button>
             </div>
         `;
@@ -73,6 +52,156 @@ function renderData(data) {
     addRestaurantButton.textContent = 'Add Restaurant';
     addRestaurantButton.onclick = addRestaurant;
     container.appendChild(addRestaurantButton);
+    const saveAllButton = document.createElement('button');
+    saveAllButton.textContent = 'Save All Changes';
+    saveAllButton.onclick = saveAllChanges;
+    container.appendChild(saveAllButton);
+    reopenNodes(container);
+}
+
+function renderToggle(path, label, count) {
+    const key = nodeKey(path);
+    return `
+        <button id="toggle-${key}" onclick="toggleNode('${key}')">${label} (${count || 0})</button>
+        <div class="children" id="children-${key}"></div>
+    `;
+}
+
+function toggleNode(key) {
+    if (expandedNodes.has(key)) {
+        expandedNodes.delete(key);
+        document.getElementById(`children-${key}`).innerHTML = '';
+    } else {
+        expandedNodes.add(key);
+        loadChildren(nodePath(key));
+    }
+}
+
+function reopenNodes(container) {
+    container.querySelectorAll('.children').forEach(children => {
+        const key = children.id.slice('children-'.length);
+        if (expandedNodes.has(key)) loadChildren(nodePath(key));
+    });
+}
+
+function loadChildren(path) {
+    fetchNode(path, node => renderChildren(path, node));
+}
+
+// Reloads the children of the node at path after a change, opening it if
+// it was closed. The top of the tree reloads the list of restaurants. After
+// a delete the positions below path move, so the nodes opened under it are
+// closed rather than reopened at the wrong position.
+function refreshNode(path, closeChildren) {
+    if (closeChildren) {
+        const prefix = path.length ? nodeKey(path) + '/' : '';
+        Array.from(expandedNodes).filter(key => key.startsWith(prefix)).forEach(key => expandedNodes.delete(key));
+    }
+    if (path.length === 0) {
+        fetchData();
+        return;
+    }
+    expandedNodes.add(nodeKey(path));
+    loadChildren(path);
+}
+
+function renderChildren(path, node) {
+    const key = nodeKey(path);
+    const container = document.getElementById(`children-${key}`);
+    if (!container || !expandedNodes.has(key)) return;
+    const toggle = document.getElementById(`toggle-${key}`);
+    toggle.textContent = toggle.textContent.replace(/\(\d+\)$/, `(${node.childCount || 0})`);
+
+    const [restaurantIndex, menuIndex, categoryIndex] = [path[1], path[3], path[5]];
+    if (path.length === 2) {
+        container.innerHTML = node.menus.map((menu, menuIndex) => `
+            <div class="menu">
+                <label for="menu-${restaurantIndex}-${menuIndex}">Menu:</label>
+                <input type="text" value="${menu.name}" id="menu-${restaurantIndex}-${menuIndex}">
+                <button onclick="updateMenu(${restaurantIndex}, ${menuIndex})">Update Menu Name</button>
+                <button onclick="deleteMenu(${restaurantIndex}, ${menuIndex})">Delete Menu</button>
+                ${renderToggle(path.concat(['menus', menuIndex]), 'Categories', menu.childCount)}
+                <button onclick="addCategory(${restaurantIndex}, ${menuIndex})">Add Category</button>
+            </div>
+        `).join('');
+    } else if (path.length === 4) {
+        container.innerHTML = node.categories.map((category, categoryIndex) => `
+            <div class="category">
+                <label for="category-${restaurantIndex}-${menuIndex}-${categoryIndex}">Category:</label> 
+                <input type="text" value="${category.name}" id="category-${restaurantIndex}-${menuIndex}-${categoryIndex}">
+                <button onclick="updateCategory(${restaurantIndex}, ${menuIndex}, ${categoryIndex})">Update Category</button>
+                <button onclick="deleteCategory(${restaurantIndex}, ${menuIndex}, ${categoryIndex})">Delete Category</button>
+                ${renderToggle(path.concat(['categories', categoryIndex]), 'Items', category.childCount)}
+                <button onclick="addItem(${restaurantIndex}, ${menuIndex}, ${categoryIndex})">Add Item</button>
+            </div>
+        `).join('');
+    } else {
+        container.innerHTML = node.items.map((item, itemIndex) => `
+            <div class="item">
+                <label for="item-name-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">Item:</label>
+                <input type="text" value="${item.name}" id="item-name-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">
+                <label for="item-price-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">Price: £</label>
+                <input type="number" step="0.01" value="${item.price}" placeholder="0.00" min="0.00" id="item-price-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">
+                ${item.dietary.map((dietary, dietaryIndex) => `
+                    <div class="dietary">
+                        <label for="item-dietary-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}-${dietaryIndex}">Dietary/Allergy Info:</label>
+                        <input type="text" value="${dietary}" id="item-dietary-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}-${dietaryIndex}">
+                        <button onclick="updateDietaryRequirement(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex}, ${dietaryIndex})">Update Dietary Requirement</button>
+                        <button onclick="deleteDietaryRequirement(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex}, ${dietaryIndex})">Delete Dietary Requirement</button>
+                    </div>
+                `).join('')}
+                <button onclick="addDietaryRequirement(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex})">Add Dietary Requirement</button>
+                <label for="item-reward-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">Reward Eligible:</label>
+                <input type="checkbox" id="item-reward-${restaurantIndex}-${menuIndex}-${categoryIndex}-${itemIndex}">
+                <button onclick="updateItem(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex})">Update Item Details</button>
+                <button onclick="deleteItem(${restaurantIndex}, ${menuIndex}, ${categoryIndex}, ${itemIndex})">Delete Item</button>
+            </div>
+        `).join('');
+    }
+    reopenNodes(container);
+}
+
+// Sends every edited field in one /api/batch request instead of one request per field
+function saveAllChanges() {
+    const operations = [];
+    const items = new Set();
+
+    document.querySelectorAll('#restaurants-container input[original-value]').forEach(input => {
+        const currentValue = input.type === 'checkbox' ? input.checked.toString() : input.value;
+        if (currentValue === input.getAttribute('original-value')) return;
+
+        let match;
+        if ((match = input.id.match(/^restaurant-(\d+)$/))) {
+            operations.push({ op: 'update', path: ['restaurants', +match[1], 'name'], newData: input.value });
+        } else if ((match = input.id.match(/^menu-(\d+)-(\d+)$/))) {
+            operations.push({ op: 'update', path: ['restaurants', +match[1], 'menus', +match[2], 'name'], newData: input.value });
+        } else if ((match = input.id.match(/^category-(\d+)-(\d+)-(\d+)$/))) {
+            operations.push({ op: 'update', path: ['restaurants', +match[1], 'menus', +match[2], 'categories', +match[3], 'name'], newData: input.value });
+        } else if ((match = input.id.match(/^item-dietary-(\d+)-(\d+)-(\d+)-(\d+)-(\d+)$/))) {
+            operations.push({ op: 'update', path: ['restaurants', +match[1], 'menus', +match[2], 'categories', +match[3], 'items', +match[4], 'dietary', +match[5]], newData: input.value });
+        } else if ((match = input.id.match(/^item-(?:name|price|reward)-(\d+-\d+-\d+-\d+)$/))) {
+            items.add(match[1]);
+        }
+    });
+
+    items.forEach(key => {
+        const [restaurantIndex, menuIndex, categoryIndex, itemIndex] = key.split('-').map(Number);
+        const name = document.getElementById(`item-name-${key}`).value;
+        const price = parseFloat(document.getElementById(`item-price-${key}`).value);
+        const rewardEligible = document.getElementById(`item-reward-${key}`).checked;
+        operations.push({ op: 'update', path: ['restaurants', restaurantIndex, 'menus', menuIndex, 'categories', categoryIndex, 'items', itemIndex], newData: { name, price, rewardEligible } });
+    });
+
+    if (operations.length === 0) return;
+
+    const xhttp = new XMLHttpRequest();
+    xhttp.open('POST', '/api/batch', true);
+    xhttp.setRequestHeader('Content-Type', 'application/json');
+    xhttp.onload = function () {
+        if (xhttp.status === 200) fetchData();
+        else alert('Failed to save changes');
+    };
+    xhttp.send(JSON.stringify({ operations }));
 }
 
 function updateRestaurant(restaurantIndex) {
@@ -83,7 +212,7 @@ function updateRestaurant(restaurantIndex) {
     xhttp.open('PUT', '/api/update_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode([]);
         else alert('Failed to update restaurant');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -97,7 +226,7 @@ function updateMenu(restaurantIndex, menuIndex) {
     xhttp.open('PUT', '/api/update_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex]);
         else alert('Failed to update menu');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -111,7 +240,7 @@ function updateCategory(restaurantIndex, menuIndex, categoryIndex) {
     xhttp.open('PUT', '/api/update_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex]);
         else alert('Failed to update category');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -128,7 +257,7 @@ function updateItem(restaurantIndex, menuIndex, categoryIndex, itemIndex) {
     xhttp.open('PUT', '/api/update_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex, 'categories', categoryIndex]);
         else alert('Failed to update item');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -142,7 +271,7 @@ function updateDietaryRequirement(restaurantIndex, menuIndex, categoryIndex, ite
     xhttp.open('PUT', '/api/update_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex, 'categories', categoryIndex]);
         else alert('Failed to update dietary requirement');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -155,7 +284,7 @@ function addRestaurant() {
     xhttp.open('POST', '/api/add_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode([]);
         else alert('Failed to add restaurant');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -168,7 +297,7 @@ function addMenu(restaurantIndex) {
     xhttp.open('POST', '/api/add_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex]);
         else alert('Failed to add menu');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -181,7 +310,7 @@ function addCategory(restaurantIndex, menuIndex) {
     xhttp.open('POST', '/api/add_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex]);
         else alert('Failed to add category');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -194,7 +323,7 @@ function addItem(restaurantIndex, menuIndex, categoryIndex) {
     xhttp.open('POST', '/api/add_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex, 'categories', categoryIndex]);
         else alert('Failed to add category');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -207,7 +336,7 @@ function addDietaryRequirement(restaurantIndex, menuIndex, categoryIndex, itemIn
     xhttp.open('POST', '/api/add_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex, 'categories', categoryIndex]);
         else alert('Failed to add dietary requirement');
     };
     xhttp.send(JSON.stringify({ path, newData }));
@@ -219,7 +348,7 @@ function deleteRestaurant(restaurantIndex) {
     xhttp.open('DELETE', '/api/delete_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode([], true);
         else alert('Failed to delete restaurant');
     };
     xhttp.send(JSON.stringify({ path }));
@@ -231,7 +360,7 @@ function deleteMenu(restaurantIndex, menuIndex) {
     xhttp.open('DELETE', '/api/delete_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex], true);
         else alert('Failed to delete menu');
     };
     xhttp.send(JSON.stringify({ path }));
@@ -243,7 +372,7 @@ function deleteCategory(restaurantIndex, menuIndex, categoryIndex) {
     xhttp.open('DELETE', '/api/delete_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex], true);
         else alert('Failed to delete category');
     };
     xhttp.send(JSON.stringify({ path }));
@@ -255,7 +384,7 @@ function deleteItem(restaurantIndex, menuIndex, categoryIndex, itemIndex) {
     xhttp.open('DELETE', '/api/delete_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex, 'categories', categoryIndex], true);
         else alert('Failed to delete item');
     };
     xhttp.send(JSON.stringify({ path }));
@@ -267,7 +396,7 @@ function deleteDietaryRequirement(restaurantIndex, menuIndex, categoryIndex, ite
     xhttp.open('DELETE', '/api/delete_data', true);
     xhttp.setRequestHeader('Content-Type', 'application/json');
     xhttp.onload = function () {
-        if (xhttp.status === 200) fetchData();
+        if (xhttp.status === 200) refreshNode(['restaurants', restaurantIndex, 'menus', menuIndex, 'categories', categoryIndex], true);
         else alert('Failed to delete dietary requirement');
     };
     xhttp.send(JSON.stringify({ path }));
@@ -1,7 +1,28 @@
 import unittest
-from app import app
+import itertools
+from app import app, get_storage, get_validator, get_view_cache
 import shutil
 import os
+import json
+import gzip
+import threading
+import menu_storage
+import menu_cache
+import menu_index
+import menu_json
+import menu_shards
+import menu_sqlite
+import menu_shared
+import menu_query
+import menu_results
+import sys
+import menu_generator
+import benchmark
+
+def build_query_part(data):
+    # The same (names, facets, ancestors, prices) part that get_query_parts makes
+    return (menu_index.build_name_indexes(data), menu_index.build_facet_index(data),
+            menu_index.build_ancestor_index(data), menu_index.build_price_index(data))
 
 class TestApp(unittest.TestCase):
     def setUp(self):
@@ -21,8 +42,18 @@ class TestApp(unittest.TestCase):
         self.app.testing = True
 
     def tearDown(self):
-        if os.path.exists(self.test_data_path):
-            os.remove(self.test_data_path)
+        if app.config.get('MENU_STORAGE') == 'sqlite':
+            get_storage().close()
+        app.config.pop('MENU_STORAGE', None)
+        app.config.pop('MENU_EVENTS_QUEUE_SIZE', None)
+        shutil.rmtree(os.path.splitext(self.test_data_path)[0] + '.shards', ignore_errors=True)
+        shutil.rmtree(os.path.splitext(self.test_data_path)[0] + '.shared', ignore_errors=True)
+        database = os.path.splitext(self.test_data_path)[0] + '.sqlite3'
+        menu_cache.wait_for_warm_starts()
+        for path in [self.test_data_path, self.test_data_path + '.journal', self.test_data_path + '.lock', self.test_data_path + '.warm',
+                     database, database + '-wal', database + '-shm']:
+            if os.path.exists(path):
+                os.remove(path)
 
     def test_update_restaurants_data(self):
         response = self.app.post('/api/add_data', json={
@@ -291,6 +322,1069 @@ class TestApp(unittest.TestCase):
 
         self.undo_changes()
 
+    def test_search_sees_added_data(self):
+        response = self.app.post('/api/add_data', json={
+            'path': ['restaurants', 0, 'menus', 0, 'categories', 0, 'items'],
+            'newData': {'name': 'Cache Test Item', 'price': 1.99, 'dietary': [], 'rewardEligible': False}
+        })
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=Cache Test Item')
+        self.assertEqual(response.status_code, 200)
+
+        self.undo_changes()
+
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=Cache Test Item')
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_name_substring(self):
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=PEPPER')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['name'] for item in json.loads(response.data)], ['Pepperoni', 'Pepperoni'])
+
+        response = self.app.get('/api/get_data/search?area=menus&option=name&name=me')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Standard Menu', [menu['name'] for menu in json.loads(response.data)])
+
+        response = self.app.get('/api/get_data/search?area=restaurants&option=name&name=*')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 2)
+
+        response = self.app.get('/api/get_data/search?area=categories&option=name&name=xyzzy')
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_by_id(self):
+        response = self.app.get('/api/get_data/search?id=7c02caeb-4ef4-493c-a756-b853aff660b9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['name'] for item in json.loads(response.data)], ['Motzerella'])
+
+        response = self.app.get('/api/get_data/search?id=not-an-id')
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_items_by_id(self):
+        response = self.app.post('/api/get_data/items', json={
+            'ids': ['d8c6916d-e5a6-4029-b0a8-385a81809056', 'not-an-id']
+        })
+        self.assertEqual(response.status_code, 200)
+
+        result = json.loads(response.data)
+        item = result['items']['d8c6916d-e5a6-4029-b0a8-385a81809056']
+        self.assertEqual(item['item']['name'], 'Pepsi')
+        self.assertEqual(item['path'], ['restaurants', 0, 'menus', 0, 'categories', 0, 'items', 0])
+        self.assertEqual(result['missing'], ['not-an-id'])
+
+    def test_get_items_by_id_invalid(self):
+        response = self.app.post('/api/get_data/items', json={'ids': 'not-a-list'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, b'Invalid ids parameter')
+
+    def test_search_dietary_requirements(self):
+        response = self.app.get('/api/get_data/search?dietary_requirements=Vegetarian')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Motzerella', [item['name'] for item in json.loads(response.data)])
+
+        response = self.app.get('/api/get_data/search?dietary_requirements=*')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(item['dietary'] for item in json.loads(response.data)))
+
+    def test_search_combined_facets(self):
+        response = self.app.get('/api/get_data/search?dietary_requirements=Vegan&reward_eligible=true')
+        self.assertEqual(response.status_code, 200)
+        for item in json.loads(response.data):
+            self.assertIn('Vegan', item['dietary'])
+            self.assertTrue(item['rewardEligible'])
+
+        response = self.app.get('/api/get_data/search?dietary_requirements=Vegan&dietary_requirements=Vegetarian')
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_reward_eligible_invalid(self):
+        response = self.app.get('/api/get_data/search?reward_eligible=maybe')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, b'Invalid search parameter (reward_eligible)')
+
+    def test_get_data_etag(self):
+        response = self.app.get('/api/get_data')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), json.loads(self.original_data))
+        etag = response.headers['ETag']
+
+        response = self.app.get('/api/get_data', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        self.app.put('/api/update_data', json={
+            'path': ['restaurants', 0, 'name'],
+            'newData': 'etag test'
+        })
+
+        response = self.app.get('/api/get_data', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        self.undo_changes()
+
+    def test_get_data_gzip(self):
+        response = self.app.get('/api/get_data', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.data)), json.loads(self.original_data))
+
+    def test_journal_storage(self):
+        app.config['MENU_STORAGE'] = 'journal'
+
+        response = self.app.post('/api/add_data', json={
+            'path': ['restaurants', 0, 'menus', 0, 'categories', 0, 'items'],
+            'newData': {'name': 'Journal Item', 'price': 1.99, 'dietary': [], 'rewardEligible': False}
+        })
+        self.assertEqual(response.status_code, 200)
+        response = self.app.put('/api/update_data', json={
+            'path': ['restaurants', 0, 'name'],
+            'newData': 'Journal Restaurant'
+        })
+        self.assertEqual(response.status_code, 200)
+
+        # The base file is untouched until the journal is compacted
+        with open(self.test_data_path, 'r') as f:
+            self.assertEqual(f.read(), self.original_data)
+        with open(self.test_data_path + '.journal', 'r') as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=Journal Item')
+        self.assertEqual(response.status_code, 200)
+        response = self.app.get('/api/get_data')
+        self.assertEqual(json.loads(response.data)['restaurants'][0]['name'], 'Journal Restaurant')
+
+        get_storage().compact()
+
+        with open(self.test_data_path, 'r') as f:
+            data = json.load(f)
+        self.assertEqual(data['restaurants'][0]['name'], 'Journal Restaurant')
+        with open(self.test_data_path + '.journal', 'r') as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+        # Editing the base file by hand invalidates the journal
+        self.undo_changes()
+        response = self.app.get('/api/get_data')
+        self.assertEqual(json.loads(response.data), json.loads(self.original_data))
+
+    def test_sqlite_storage(self):
+        app.config['MENU_STORAGE'] = 'sqlite'
+
+        # The database is filled from the menu file the first time it is used
+        response = self.app.get('/api/get_data')
+        self.assertEqual(json.loads(response.data), json.loads(self.original_data))
+
+        response = self.app.post('/api/batch', json={'operations': [
+            {'op': 'update', 'path': ['restaurants', 0, 'name'], 'newData': 'SQLite Restaurant'},
+            {'op': 'add', 'path': ['restaurants', 0, 'menus', 0, 'categories', 0, 'items'], 'newData': {'name': 'SQLite Item', 'price': 3.5, 'dietary': ['vegan'], 'rewardEligible': True}},
+            {'op': 'update', 'path': ['restaurants', 0, 'menus', 0, 'categories', 0, 'items', 0], 'newData': {'name': 'Renamed Item', 'price': '4.25', 'rewardEligible': False}},
+            {'op': 'delete', 'path': ['restaurants', 0, 'menus', 0, 'categories', 0, 'items', 1]}
+        ]})
+        self.assertEqual(response.status_code, 200)
+        expected = json.loads(self.app.get('/api/get_data').data)
+
+        # The menu file is no longer written, the database holds the menu
+        with open(self.test_data_path, 'r') as f:
+            self.assertEqual(f.read(), self.original_data)
+
+        # Reloading from the tables gives back the same tree
+        get_storage().close()
+        self.assertEqual(json.loads(self.app.get('/api/get_data').data), expected)
+        self.assertEqual(expected['restaurants'][0]['name'], 'SQLite Restaurant')
+        items = expected['restaurants'][0]['menus'][0]['categories'][0]['items']
+        self.assertEqual(items[0]['name'], 'Renamed Item')
+        self.assertEqual(items[0]['price'], 4.25)
+        self.assertEqual(items[-1]['name'], 'SQLite Item')
+
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=SQLite Item')
+        self.assertEqual(response.status_code, 200)
+
+        # Versions and changes survive a restart
+        response = self.app.get('/api/get_data/changes?since=0')
+        self.assertEqual(json.loads(response.data)['version'], 4)
+        self.assertEqual(len(json.loads(response.data)['changes']), 4)
+
+    def test_sqlite_import_once(self):
+        app.config['MENU_STORAGE'] = 'sqlite'
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'SQLite Restaurant'})
+        self.assertEqual(response.status_code, 200)
+
+        # A second worker that found the database empty before the first one
+        # filled it does not import the menu file over the first one's commits
+        database = os.path.splitext(self.test_data_path)[0] + '.sqlite3'
+        connection = menu_sqlite.connect(database)
+        menu_sqlite.import_menu(connection, self.test_data_path, replace=False)
+        self.assertEqual(menu_sqlite.get_version(connection), 1)
+        self.assertEqual(menu_sqlite.load_menu(connection)['restaurants'][0]['name'], 'SQLite Restaurant')
+
+        # Running menu_sqlite.py imports it again
+        menu_sqlite.import_menu(connection, self.test_data_path)
+        self.assertEqual(menu_sqlite.get_version(connection), 2)
+        self.assertEqual(menu_sqlite.load_menu(connection)['restaurants'][0]['name'], 'Restaurant A')
+        connection.close()
+
+    def test_sharded_storage(self):
+        app.config['MENU_STORAGE'] = 'sharded'
+        shards = os.path.splitext(self.test_data_path)[0] + '.shards'
+
+        response = self.app.get('/api/get_data')
+        self.assertEqual(json.loads(response.data), json.loads(self.original_data))
+        files = set(os.listdir(shards))
+        self.assertEqual(len(files), 3)
+
+        # Only the shard of the restaurant that changed is written
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 1, 'menus', 0, 'name'], 'newData': 'Sharded Menu'})
+        self.assertEqual(response.status_code, 200)
+        added = set(os.listdir(shards)) - files
+        self.assertEqual(len(added), 1)
+        with open(os.path.join(shards, added.pop()), 'r') as f:
+            self.assertEqual(json.load(f)['menus'][0]['name'], 'Sharded Menu')
+
+        response = self.app.post('/api/add_data', json={
+            'path': ['restaurants'],
+            'newData': {'name': 'Sharded Restaurant', 'menus': [{'name': 'Menu', 'categories': [{'name': 'Category', 'items': [{'name': 'Sharded Item', 'price': 1, 'dietary': [], 'rewardEligible': False}]}]}]}
+        })
+        self.assertEqual(response.status_code, 200)
+        response = self.app.delete('/api/delete_data', json={'path': ['restaurants', 0]})
+        self.assertEqual(response.status_code, 200)
+
+        data = json.loads(self.app.get('/api/get_data').data)
+        self.assertEqual([restaurant['name'] for restaurant in data['restaurants']], ['Restaurant B', 'Sharded Restaurant'])
+        self.assertEqual(data['restaurants'][0]['menus'][0]['name'], 'Sharded Menu')
+
+        # Searches cover every shard
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=Sharded Item')
+        self.assertEqual(json.loads(response.data)[0]['name'], 'Sharded Item')
+        response = self.app.get('/api/get_data/search?area=menus&option=name&name=Sharded')
+        self.assertEqual(len(json.loads(response.data)), 1)
+
+        # A restaurant's menu only reads that restaurant's shard
+        storage = menu_shards.ShardedStorage(self.test_data_path)
+        snapshot = storage.snapshot()
+        self.assertEqual(len(storage._shards), 0)
+        self.assertEqual(snapshot.restaurants_named('Sharded Restaurant')[0]['name'], 'Sharded Restaurant')
+        self.assertEqual(len(storage._shards), 1)
+        self.assertEqual(snapshot.version, 3)
+
+    def age_files(self, directory):
+        # As if every file there was written an hour ago
+        written = os.path.getmtime(directory) - 3600
+        for name in os.listdir(directory):
+            os.utime(os.path.join(directory, name), (written, written))
+
+    def test_sharded_storage_keeps_replaced_shards(self):
+        app.config['MENU_STORAGE'] = 'sharded'
+        shards = os.path.splitext(self.test_data_path)[0] + '.shards'
+        self.app.get('/api/get_data')
+        other = menu_shards.ShardedStorage(self.test_data_path)
+        snapshot = other.snapshot()
+
+        self.age_files(shards)
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'Replaced'})
+        self.assertEqual(response.status_code, 200)
+
+        # A worker still on the previous manifest can read the shard that was
+        # replaced, however long ago it was written
+        self.assertEqual(snapshot.restaurant_at(0)['name'], 'Restaurant A')
+
+        # It is removed once it has been unused for long enough
+        self.age_files(shards)
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 1, 'name'], 'newData': 'Replaced'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(os.listdir(shards)), 4)
+
+    def first_write(self, storage_type):
+        # The first request on a new storage is a write, which has to fill
+        # the storage from menus.json while the write lock is wanted
+        app.config['MENU_STORAGE'] = storage_type
+        responses = []
+        thread = threading.Thread(target=lambda: responses.append(
+            self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'First Write'})), daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0].status_code, 200)
+        data = json.loads(self.app.get('/api/get_data').data)
+        self.assertEqual(data['restaurants'][0]['name'], 'First Write')
+
+    def test_sharded_storage_first_write(self):
+        self.first_write('sharded')
+
+    def test_shared_storage_keeps_replaced_generations(self):
+        app.config['MENU_STORAGE'] = 'shared'
+        directory = os.path.splitext(self.test_data_path)[0] + '.shared'
+        self.app.get('/api/get_data')
+        with open(os.path.join(directory, 'current'), 'r') as f:
+            first = f.read()
+
+        # A worker that read current just before a commit can still open the
+        # generation it names, however long ago it was written
+        self.age_files(directory)
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'Replaced'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(menu_shared.Generation(os.path.join(directory, first)).header['version'], 0)
+
+        # It is removed once it has been unused for long enough
+        self.age_files(directory)
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 1, 'name'], 'newData': 'Replaced'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(first, os.listdir(directory))
+        self.assertEqual(len([name for name in os.listdir(directory) if name.endswith('.menu')]), 2)
+
+    def test_shared_storage_first_write(self):
+        self.first_write('shared')
+
+    def test_shared_storage(self):
+        urls = [
+            '/api/get_data',
+            '/api/get_data?restaurant=Restaurant B',
+            '/api/get_data?fields=name,price',
+            '/api/get_data/node?path=restaurants/0/menus/1&depth=1&counts=true',
+            '/api/get_data/search?area=items&option=name&name=pep',
+            '/api/get_data/search?area=categories&option=name&name=*&restaurant=Restaurant A',
+            '/api/get_data/search?area=items&option=contains&name=Vegan',
+            '/api/get_data/search?area=items&option=fuzzy&name=peperoni',
+            '/api/get_data/search?dietary_requirements=Vegetarian&reward_eligible=false',
+            '/api/get_data/search?max_price=5&sort=price',
+            '/api/get_data/search?id=*&limit=3',
+            '/api/get_data/query?area=restaurants&dietary_requirements=Vegan',
+            '/api/get_data/query?name=pep&min_price=3',
+        ]
+        expected = [json.loads(self.app.get(url).data) for url in urls]
+        item = expected[0]['restaurants'][0]['menus'][0]['categories'][0]['items'][0]
+
+        app.config['MENU_STORAGE'] = 'shared'
+        for url, body in zip(urls, expected):
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 200, url)
+            self.assertEqual(json.loads(response.data), body, url)
+        response = self.app.get('/api/get_data/search?id=' + item['id'])
+        self.assertEqual(json.loads(response.data), [item])
+        response = self.app.post('/api/get_data/items', json={'ids': [item['id']]})
+        self.assertEqual(json.loads(response.data)['items'][item['id']]['path'], ['restaurants', 0, 'menus', 0, 'categories', 0, 'items', 0])
+
+        # Another worker maps the same generation, and only parses what it returns
+        other = menu_shared.SharedStorage(self.test_data_path)
+        snapshot = other.snapshot()
+        self.assertEqual(snapshot.signature, get_storage().snapshot().signature)
+        names = [item['name'] for item in snapshot.derived('names', None)['items'].search('pep')]
+        self.assertEqual(names, [item['name'] for item in expected[4]])
+        self.assertIsNone(snapshot._data)
+
+        # A write publishes a new generation, which every worker moves to
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 1, 'menus', 0, 'name'], 'newData': 'Shared Menu'})
+        self.assertEqual(response.status_code, 200)
+        snapshot = other.snapshot()
+        self.assertEqual(snapshot.version, 1)
+        self.assertEqual(snapshot.restaurant_at(1)['menus'][0]['name'], 'Shared Menu')
+        response = self.app.get('/api/get_data/search?area=menus&option=name&name=shared')
+        self.assertEqual([menu['name'] for menu in json.loads(response.data)], ['Shared Menu'])
+
+        response = self.app.delete('/api/delete_data', json={'path': ['restaurants', 0]})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(self.app.get('/api/get_data').data)
+        self.assertEqual([restaurant['name'] for restaurant in data['restaurants']], ['Restaurant B'])
+        self.assertEqual(other.snapshot().version, 2)
+
+    def test_search_fuzzy(self):
+        response = self.app.get('/api/get_data/search?area=items&option=fuzzy&name=peperoni')
+        self.assertEqual(response.status_code, 200)
+        names = [item['name'] for item in json.loads(response.data)]
+        self.assertEqual(names[:2], ['Pepperoni', 'Pepperoni'])
+        self.assertIn('Kids Peperoin Pizza', names)
+
+        response = self.app.get('/api/get_data/search?area=items&option=fuzzy&name=mozarella&limit=1')
+        self.assertEqual([item['name'] for item in json.loads(response.data)], ['Motzerella'])
+
+        response = self.app.get('/api/get_data/search?area=categories&option=fuzzy&name=pizas')
+        self.assertEqual([category['name'] for category in json.loads(response.data)][0], 'Pizzas')
+
+        response = self.app.get('/api/get_data/search?area=items&option=fuzzy&name=xyzzy')
+        self.assertEqual(response.status_code, 404)
+
+    def test_query_combined_filters(self):
+        response = self.app.get('/api/get_data/query?dietary_requirements=Vegetarian&max_price=6')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['name'] for item in json.loads(response.data)], ['Motzerella', 'Olives', 'Soup of the Day'])
+
+        response = self.app.get('/api/get_data/query?area=restaurants&dietary_requirements=Vegan')
+        self.assertEqual([restaurant['name'] for restaurant in json.loads(response.data)], ['Restaurant A'])
+
+        response = self.app.get('/api/get_data/query?name=pep&min_price=3&limit=1')
+        self.assertEqual([item['name'] for item in json.loads(response.data)], ['Pepperoni'])
+        self.assertIn('X-Next-Cursor', response.headers)
+
+        response = self.app.get('/api/get_data/query?name=zz&dietary_requirements=Vegan')
+        self.assertEqual(response.status_code, 404)
+        response = self.app.get('/api/get_data/query?min_price=cheap')
+        self.assertEqual(response.status_code, 400)
+        response = self.app.get('/api/get_data/query?area=dishes')
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_price(self):
+        response = self.app.get('/api/get_data/search?max_price=3.5&sort=price')
+        self.assertEqual(response.status_code, 200)
+        prices = [item['price'] for item in json.loads(response.data)]
+        self.assertEqual(prices, sorted(prices))
+        self.assertTrue(prices and all(price <= 3.5 for price in prices))
+
+        response = self.app.get('/api/get_data/search?min_price=5&dietary_requirements=Vegetarian')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(item['price'] >= 5 and 'Vegetarian' in item['dietary'] for item in json.loads(response.data)))
+
+        # The cheapest item, then the next
+        response = self.app.get('/api/get_data/search?id=*&sort=price&limit=1')
+        cheapest = json.loads(response.data)
+        response = self.app.get('/api/get_data/search?id=*&sort=price&limit=1&cursor=' + response.headers['X-Next-Cursor'])
+        self.assertLessEqual(cheapest[0]['price'], json.loads(response.data)[0]['price'])
+
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=pep&sort=price')
+        prices = [item['price'] for item in json.loads(response.data)]
+        self.assertEqual(prices, sorted(prices))
+
+        # Prices are kept up to date as items change
+        self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'menus', 0, 'categories', 0, 'items', 0], 'newData': {'name': 'Pepsi', 'price': 0.5, 'rewardEligible': False}})
+        response = self.app.get('/api/get_data/query?sort=price&limit=1')
+        self.assertEqual(json.loads(response.data)[0]['price'], 0.5)
+
+        response = self.app.get('/api/get_data/search?min_price=1000')
+        self.assertEqual(response.status_code, 404)
+        for query in ['max_price=cheap', 'min_price=nan', 'sort=name&id=*', 'area=restaurants&option=name&name=*&sort=price']:
+            response = self.app.get('/api/get_data/search?' + query)
+            self.assertEqual(response.status_code, 400, query)
+        response = self.app.get('/api/get_data/query?area=menus&sort=price')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_node(self):
+        with open(self.test_data_path, 'r') as f:
+            data = json.load(f)
+
+        response = self.app.get('/api/get_data/node?path=restaurants/0/menus/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), data['restaurants'][0]['menus'][1])
+        self.assertIn('X-Menu-Version', response.headers)
+
+        # The top of the tree, one level down, with how many menus each restaurant has
+        response = self.app.get('/api/get_data/node?depth=1&counts=true')
+        root = json.loads(response.data)
+        self.assertEqual(root['childCount'], len(data['restaurants']))
+        for restaurant, original in zip(root['restaurants'], data['restaurants']):
+            self.assertEqual(restaurant, {'name': original['name'], 'childCount': len(original['menus'])})
+
+        response = self.app.get('/api/get_data/node?path=restaurants/0/menus&depth=0')
+        self.assertEqual([menu['name'] for menu in json.loads(response.data)], [menu['name'] for menu in data['restaurants'][0]['menus']])
+        self.assertNotIn('categories', json.loads(response.data)[0])
+
+        # Dietary lists are part of an item, not children
+        response = self.app.get('/api/get_data/node?path=restaurants/0/menus/0/categories/0/items/0&depth=0')
+        self.assertEqual(json.loads(response.data), data['restaurants'][0]['menus'][0]['categories'][0]['items'][0])
+
+        self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'menus', 1, 'name'], 'newData': 'Brunch'})
+        response = self.app.get('/api/get_data/node?path=restaurants/0/menus/1&depth=0')
+        self.assertEqual(json.loads(response.data)['name'], 'Brunch')
+
+        for query in ['path=restaurants/9', 'path=restaurants/0/dishes', 'path=restaurants/0/name/0']:
+            response = self.app.get('/api/get_data/node?' + query)
+            self.assertEqual(response.status_code, 404, query)
+        for query in ['depth=-1', 'depth=two', 'counts=yes']:
+            response = self.app.get('/api/get_data/node?' + query)
+            self.assertEqual(response.status_code, 400, query)
+
+    def test_get_node_sharded(self):
+        app.config['MENU_STORAGE'] = 'sharded'
+        with open(self.test_data_path, 'r') as f:
+            data = json.load(f)
+
+        response = self.app.get('/api/get_data/node?path=restaurants/1&depth=1&counts=true')
+        restaurant = json.loads(response.data)
+        self.assertEqual(restaurant['name'], data['restaurants'][1]['name'])
+        self.assertEqual([menu['childCount'] for menu in restaurant['menus']], [len(menu['categories']) for menu in data['restaurants'][1]['menus']])
+
+    def test_warm_start(self):
+        menu_cache.clear_cache()
+        storage = menu_storage.JsonFileStorage(self.test_data_path, warm_start=True)
+        # The first worker parses the menu and writes the warm start file for the next
+        storage.snapshot()
+        menu_cache.wait_for_warm_starts()
+        self.assertTrue(os.path.exists(menu_cache.warm_start_path(self.test_data_path)))
+
+        def not_built(data):
+            raise AssertionError('index rebuilt')
+
+        menu_cache.clear_cache()
+        snapshot = menu_storage.JsonFileStorage(self.test_data_path, warm_start=True).snapshot()
+        with open(self.test_data_path, 'r') as f:
+            self.assertEqual(snapshot.data, json.load(f))
+        for key in menu_cache.WARM_START_INDEXES:
+            snapshot.derived(key, not_built)
+        # The indexes point at the nodes of the loaded tree
+        item = snapshot.data['restaurants'][0]['menus'][0]['categories'][0]['items'][0]
+        self.assertIs(snapshot.derived('ids', not_built)[item['id']][0][0], item)
+
+        # A commit writes a new one, and one for an older menu is not used
+        with open(menu_cache.warm_start_path(self.test_data_path), 'rb') as f:
+            old_warm_start = f.read()
+        storage.commit([{'op': 'update', 'path': ['restaurants', 0, 'name'], 'value': 'Warm'}])
+        menu_cache.wait_for_warm_starts()
+        with open(self.test_data_path, 'rb') as f:
+            text = f.read()
+        self.assertEqual(menu_cache.load_warm_start(self.test_data_path, text)[0]['restaurants'][0]['name'], 'Warm')
+
+        with open(menu_cache.warm_start_path(self.test_data_path), 'wb') as f:
+            f.write(old_warm_start)
+        self.assertIsNone(menu_cache.load_warm_start(self.test_data_path, text))
+        menu_cache.clear_cache()
+        snapshot = menu_storage.JsonFileStorage(self.test_data_path, warm_start=True).snapshot()
+        self.assertEqual(snapshot.data['restaurants'][0]['name'], 'Warm')
+        menu_cache.clear_cache()
+
+    def test_query_matches_full_scan(self):
+        menu = menu_generator.generate_menu(restaurants=4, menus=2, categories=3, items=15, seed=3)
+        parts = [build_query_part(menu)]
+
+        def item_matches(item, query):
+            price = item['price']
+            return ((query.get('name') is None or query['area'] != 'items' or query['name'].lower() in item['name'].lower())
+                    and all(tag in item['dietary'] for tag in query.get('dietary', ()))
+                    and (query.get('reward') is None or item['rewardEligible'] == query['reward'])
+                    and (query.get('min_price') is None or price >= query['min_price'])
+                    and (query.get('max_price') is None or price <= query['max_price']))
+
+        nodes = list(menu_index.iter_nodes(menu))
+
+        def scan(query):
+            item_filtered = any(query.get(key) not in (None, ()) for key in ['dietary', 'reward', 'min_price', 'max_price'])
+            results = []
+            for level, node, path in nodes:
+                if level != query['area']:
+                    continue
+                if level != 'items' and query.get('name') is not None and query['name'].lower() not in node['name'].lower():
+                    continue
+                items = [item for item_level, item, item_path in nodes if item_level == 'items' and item_path[:len(path)] == path]
+                if (level == 'items' or item_filtered) and not any(item_matches(item, query) for item in items):
+                    continue
+                results.append(node)
+            return results
+
+        queries = [
+            {'area': 'items', 'dietary': ['Vegan'], 'max_price': 10},
+            {'area': 'items', 'name': 'chicken', 'reward': True},
+            {'area': 'items', 'name': 'ch', 'dietary': ['Vegetarian', 'Nut Free']},
+            {'area': 'items', 'min_price': 5, 'max_price': 6},
+            {'area': 'categories', 'name': 'sides', 'dietary': ['Halal'], 'reward': False},
+            {'area': 'menus', 'dietary': ['Gluten Free', 'Vegan'], 'min_price': 20},
+            {'area': 'restaurants', 'name': '2', 'max_price': 2},
+            {'area': 'restaurants'},
+        ]
+        for query in queries:
+            area = query['area']
+            options = {key: value for key, value in query.items() if key != 'area'}
+            self.assertEqual(menu_query.run_query(parts, area, **options), scan(query), query)
+
+        # Cheapest first, the same whether the menu is one part or one per restaurant
+        restaurant_parts = [build_query_part({'restaurants': [restaurant]}) for restaurant in menu['restaurants']]
+        for query in [query for query in queries if query['area'] == 'items']:
+            options = {key: value for key, value in query.items() if key != 'area'}
+            expected = sorted(scan(query), key=lambda item: item['price'])
+            self.assertEqual(menu_query.run_query(parts, 'items', sort='price', **options), expected, query)
+            self.assertEqual(menu_query.run_query(restaurant_parts, 'items', sort='price', **options), expected, query)
+
+    def test_search_cache(self):
+        stats = json.loads(self.app.get('/api/get_data/search/cache').data)
+
+        response = self.app.get('/api/get_data/search?dietary_requirements=Vegetarian&reward_eligible=false')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        first = response.data
+        response = self.app.get('/api/get_data/search?reward_eligible=false&dietary_requirements=Vegetarian')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+        self.assertEqual(response.data, first)
+        self.assertEqual(response.mimetype, 'application/json')
+
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=nothing')
+        self.assertEqual(response.status_code, 404)
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=nothing')
+        self.assertEqual((response.status_code, response.headers['X-Cache']), (404, 'HIT'))
+
+        after = json.loads(self.app.get('/api/get_data/search/cache').data)
+        self.assertEqual(after['hits'] - stats['hits'], 2)
+        self.assertEqual(after['misses'] - stats['misses'], 2)
+
+        # A change empties the cache
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'menus', 0, 'categories', 0, 'items', 0],
+                                                          'newData': {'name': 'Cached Item', 'price': 1, 'rewardEligible': False}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(self.app.get('/api/get_data/search/cache').data)['entries'], 0)
+        response = self.app.get('/api/get_data/search?dietary_requirements=Vegetarian&reward_eligible=false')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+
+    def test_search_cache_streams_large_results(self):
+        url = '/api/get_data/search?area=items&option=name&name=*'
+        expected = self.app.get(url).data
+        self.assertGreater(len(expected), 100)
+
+        # Results too big to cache are streamed rather than read into memory
+        app.config['MENU_SEARCH_CACHE_BYTES'] = 400
+        self.addCleanup(app.config.pop, 'MENU_SEARCH_CACHE_BYTES', None)
+        for n in range(2):
+            with app.test_request_context(url):
+                response = app.make_response(app.view_functions['search_data']())
+                self.assertTrue(response.is_streamed)
+                self.assertEqual(response.headers['X-Cache'], 'MISS')
+                self.assertEqual(response.get_data(), expected)
+
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=Pepperoni&fields=name')
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=Pepperoni&fields=name')
+        self.assertEqual(response.headers['X-Cache'], 'HIT')
+
+    def test_search_cache_size(self):
+        cache = menu_results.ResultCache(100)
+        cache.put('a', b'x' * 20, 200, {})
+        cache.put('b', b'x' * 20, 200, {})
+        cache.get('a')
+        for key in ['c', 'd', 'e', 'g']:
+            cache.put(key, b'x' * 20, 200, {})
+        # b was used least recently
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertLessEqual(cache.size, 100)
+        # Too big to be worth keeping
+        cache.put('f', b'x' * 60, 200, {})
+        self.assertIsNone(cache.get('f'))
+
+    def test_if_match(self):
+        version = self.app.get('/api/get_data').headers['X-Menu-Version']
+
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'First Edit'},
+                                headers={'If-Match': f'"{version}"'})
+        self.assertEqual(response.status_code, 200)
+        new_version = response.headers['X-Menu-Version']
+        self.assertEqual(int(new_version), int(version) + 1)
+
+        # A second edit based on the old version is refused
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'Second Edit'},
+                                headers={'If-Match': f'"{version}"'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.headers['X-Menu-Version'], new_version)
+        response = self.app.delete('/api/delete_data', json={'path': ['restaurants', 1]}, headers={'If-Match': version})
+        self.assertEqual(response.status_code, 409)
+        data = json.loads(self.app.get('/api/get_data').data)
+        self.assertEqual(data['restaurants'][0]['name'], 'First Edit')
+        self.assertEqual(len(data['restaurants']), 2)
+
+        # The ETag sent with the menu works as well, in any encoding
+        etag = self.app.get('/api/get_data').headers['ETag']
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'ETag Edit'},
+                                headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'Stale Edit'},
+                                headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 409)
+        etag = self.app.get('/api/get_data', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        response = self.app.put('/api/update_data', json={'path': ['restaurants', 0, 'name'], 'newData': 'Gzip ETag Edit'},
+                                headers={'If-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.app.post('/api/batch', json={'operations': [{'op': 'delete', 'path': ['restaurants', 1]}]},
+                                 headers={'If-Match': '*'})
+        self.assertEqual(response.status_code, 200)
+        response = self.app.delete('/api/delete_data', json={'path': ['restaurants', 0]}, headers={'If-Match': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, b'Invalid If-Match header')
+
+    def test_if_match_other_worker(self):
+        # Two json storages on the same file stand in for two workers, each
+        # counting its own versions
+        first = menu_storage.JsonFileStorage(self.test_data_path)
+        second = menu_storage.JsonFileStorage(self.test_data_path)
+        version = first.commit([{'op': 'update', 'path': ['restaurants', 0, 'name'], 'value': 'First Worker'}]).version
+        self.assertNotEqual(second.snapshot().version, version)
+
+        # A version from one worker is never checked against another's menu
+        with self.assertRaises(menu_storage.VersionConflict):
+            second.commit([{'op': 'update', 'path': ['restaurants', 0, 'name'], 'value': 'Second Worker'}], {version})
+        self.assertEqual(first.commit([], {version}).version, version)
+
+    def test_concurrent_writers(self):
+        # Two storages on the same file stand in for two workers
+        workers = [menu_storage.JsonFileStorage(self.test_data_path), menu_storage.JsonFileStorage(self.test_data_path)]
+        path = ['restaurants', 0, 'menus', 0, 'categories', 0, 'items']
+        before = len(json.loads(self.original_data)['restaurants'][0]['menus'][0]['categories'][0]['items'])
+
+        def add_items(storage, name):
+            for n in range(20):
+                storage.commit([{'op': 'add', 'path': path, 'value': {'name': f'{name} {n}', 'price': 1.0, 'dietary': [], 'rewardEligible': False}}])
+
+        threads = [threading.Thread(target=add_items, args=(storage, f'Worker {n}')) for n, storage in enumerate(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with open(self.test_data_path, 'r') as f:
+            items = json.load(f)['restaurants'][0]['menus'][0]['categories'][0]['items']
+        self.assertEqual(len(items), before + 40)
+
+    def test_numbers_json_cannot_hold(self):
+        item = ['restaurants', 0, 'menus', 0, 'categories', 0, 'items']
+        for storage_type in ['json', 'journal', 'sqlite', 'sharded', 'shared']:
+            app.config['MENU_STORAGE'] = storage_type
+            for method, url, body in [
+                ('PUT', '/api/update_data', {'path': item + [0], 'newData': {'name': 'NaN', 'price': float('nan'), 'rewardEligible': True}}),
+                ('PUT', '/api/update_data', {'path': item + [0], 'newData': {'name': 'NaN', 'price': 'nan', 'rewardEligible': True}}),
+                ('PUT', '/api/update_data', {'path': ['restaurants', 0, 'name'], 'newData': 2 ** 70}),
+                ('POST', '/api/add_data', {'path': item, 'newData': {'name': 'Inf', 'price': float('inf'), 'dietary': [], 'rewardEligible': True}}),
+                ('POST', '/api/batch', {'operations': [{'op': 'update', 'path': ['restaurants', 0, 'name'], 'newData': 2 ** 70}]}),
+            ]:
+                response = self.app.open(url, method=method, json=body)
+                self.assertEqual(response.status_code, 400, (storage_type, body))
+
+            # Nothing was stored, so the menu still loads in this worker and a new one
+            self.assertEqual(self.app.get('/api/get_data').status_code, 200, storage_type)
+            storage = menu_storage.STORAGE_TYPES[storage_type](self.test_data_path)
+            self.assertEqual(storage.snapshot().data, json.loads(self.original_data), storage_type)
+            if storage_type == 'sqlite':
+                storage.close()
+                get_storage().close()
+
+    def test_menu_file_with_numbers_json_cannot_hold(self):
+        data = json.loads(self.original_data)
+        data['restaurants'][0]['menus'][0]['categories'][0]['items'][0]['price'] = float('nan')
+        data['restaurants'][0]['menus'][0]['categories'][0]['items'][1]['price'] = 2 ** 70
+        with open(self.test_data_path, 'w') as f:
+            json.dump(data, f)
+
+        # Read the way the encoder would write them, rather than not at all
+        response = self.app.get('/api/get_data')
+        self.assertEqual(response.status_code, 200)
+        items = json.loads(response.data)['restaurants'][0]['menus'][0]['categories'][0]['items']
+        self.assertIsNone(items[0]['price'])
+        self.assertEqual(items[1]['price'], float(2 ** 70))
+        self.assertEqual(menu_json.loads(b'[1e400, -Infinity, 18446744073709551616]'), [None, None, float(2 ** 64)])
+
+    def test_menu_strings_shared(self):
+        data = get_storage().snapshot().data
+        tags = [tag for level, node, path in menu_index.iter_nodes(data) if level == 'items' for tag in node.get('dietary', [])]
+        self.assertTrue(tags)
+        for tag in tags:
+            self.assertIs(tag, sys.intern(tag))
+
+        # Compact output, the same whichever encoder is installed
+        self.assertEqual(menu_json.dumps({'a': [1, 'é']}), '{"a":[1,"é"]}'.encode('utf-8'))
+
+    def test_generated_menu(self):
+        menu = menu_generator.generate_menu(restaurants=3, menus=2, categories=4, items=5, reward_ratio=1, seed=1)
+        self.assertEqual(menu, menu_generator.generate_menu(restaurants=3, menus=2, categories=4, items=5, reward_ratio=1, seed=1))
+
+        items = [node for level, node, path in menu_index.iter_nodes(menu) if level == 'items']
+        self.assertEqual(len(items), 3 * 2 * 4 * 5)
+        self.assertTrue(all(item['rewardEligible'] for item in items))
+        for restaurant in menu['restaurants']:
+            self.assertTrue(get_validator('restaurants').is_valid(restaurant))
+
+    def test_benchmark(self):
+        menu = menu_generator.generate_menu(restaurants=2, menus=1, categories=2, items=20)
+        results = benchmark.run_benchmarks(menu, repeat=3)
+
+        self.assertEqual(len(results), len(benchmark.build_cases(menu)))
+        for result in results:
+            self.assertEqual(result['statuses'], [200], result['name'])
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertIn('rss_change_kb', result)
+            self.assertNotIn('peak_rss_kb', result)
+        self.assertEqual(app.config['MENU_FILE'], self.test_data_path)
+
+    def test_batch_data(self):
+        response = self.app.post('/api/batch', json={'operations': [
+            {'op': 'update', 'path': ['restaurants', 0, 'name'], 'newData': 'Batch Restaurant'},
+            {'op': 'add', 'path': ['restaurants', 0, 'menus', 0, 'categories', 0, 'items'], 'newData': {'name': 'Batch Item', 'price': 2.5, 'dietary': [], 'rewardEligible': True}},
+            {'op': 'delete', 'path': ['restaurants', 1]}
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'Batch applied')
+
+        data = json.loads(self.app.get('/api/get_data').data)
+        self.assertEqual(data['restaurants'][0]['name'], 'Batch Restaurant')
+        self.assertEqual(len(data['restaurants']), 1)
+        item = data['restaurants'][0]['menus'][0]['categories'][0]['items'][-1]
+        self.assertEqual(item['name'], 'Batch Item')
+        self.assertEqual(item['price'], 2.5)
+        self.assertIn('id', item)
+
+        self.undo_changes()
+
+    def test_batch_data_all_or_nothing(self):
+        response = self.app.post('/api/batch', json={'operations': [
+            {'op': 'update', 'path': ['restaurants', 0, 'name'], 'newData': 'Batch Restaurant'},
+            {'op': 'delete', 'path': ['restaurants', 99]}
+        ]})
+        self.assertEqual(response.status_code, 400)
+
+        with open(self.test_data_path, 'r') as f:
+            self.assertEqual(f.read(), self.original_data)
+
+    def test_batch_data_invalid(self):
+        response = self.app.post('/api/batch', json={'operations': [
+            {'op': 'update', 'path': ['restaurants', 0, 'name'], 'newData': 'Batch Restaurant'},
+            {'op': 'move', 'path': ['restaurants', 0]}
+        ]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, b'Operation 1: Invalid operation (op must be add, update or delete)')
+
+        response = self.app.post('/api/batch', json={'operations': []})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, b'Invalid batch parameters')
+
+    def test_schema_validators_are_cached(self):
+        self.assertIs(get_validator('items'), get_validator('items'))
+        self.assertTrue(get_validator('items').is_valid({'name': 'test', 'price': 1.0, 'dietary': [], 'rewardEligible': False}))
+        self.assertFalse(get_validator('items').is_valid({'name': 'test'}))
+
+    def test_search_contains(self):
+        response = self.app.get('/api/get_data/search?area=categories&option=contains&name=Pepsi')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([category['name'] for category in json.loads(response.data)], ['Drinks'])
+
+        response = self.app.get('/api/get_data/search?area=restaurants&option=contains&name=Vegan')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Restaurant A', [restaurant['name'] for restaurant in json.loads(response.data)])
+
+        response = self.app.get('/api/get_data/search?area=menus&option=contains&name=Pepsi')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([menu['name'] for menu in json.loads(response.data)], ['Standard Menu'])
+
+        response = self.app.get('/api/get_data/search?area=items&option=contains&name=Peps')
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_pagination(self):
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=*')
+        all_items = json.loads(response.data)
+
+        pages = []
+        cursor = None
+        while True:
+            url = '/api/get_data/search?area=items&option=name&name=*&limit=3'
+            if cursor:
+                url += f'&cursor={cursor}'
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.data)
+            self.assertLessEqual(len(page), 3)
+            pages.extend(page)
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+
+        self.assertEqual(pages, all_items)
+
+    def test_search_pagination_invalid(self):
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=*&limit=0')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, b'Invalid search parameter (limit)')
+
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=*&cursor=nonsense')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, b'Invalid search parameter (cursor)')
+
+    def test_search_cursor_expires(self):
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=*&limit=1')
+        cursor = response.headers['X-Next-Cursor']
+
+        self.app.put('/api/update_data', json={
+            'path': ['restaurants', 0, 'name'],
+            'newData': 'cursor test'
+        })
+
+        response = self.app.get(f'/api/get_data/search?area=items&option=name&name=*&limit=1&cursor={cursor}')
+        self.assertEqual(response.status_code, 409)
+
+        self.undo_changes()
+
+    def test_get_data_fields(self):
+        response = self.app.get('/api/get_data?fields=name,price,image')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        restaurant = data['restaurants'][0]
+        self.assertEqual(set(restaurant.keys()), {'name', 'menus'})
+        item = restaurant['menus'][0]['categories'][0]['items'][0]
+        self.assertEqual(item, {'name': 'Pepsi', 'price': 2.99})
+
+    def test_get_data_restaurant(self):
+        response = self.app.get('/api/get_data?restaurant=Restaurant B')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([restaurant['name'] for restaurant in json.loads(response.data)['restaurants']], ['Restaurant B'])
+
+        response = self.app.get('/api/get_data?restaurant=Nowhere')
+        self.assertEqual(response.status_code, 404)
+
+    def test_get_data_views_bounded(self):
+        app.config['MENU_VIEW_CACHE_BYTES'] = 20000
+        self.addCleanup(app.config.pop, 'MENU_VIEW_CACHE_BYTES', None)
+        fields = ['name', 'price', 'image', 'id', 'dietary', 'rewardEligible']
+        for count in range(1, len(fields) + 1):
+            for subset in itertools.combinations(fields, count):
+                response = self.app.get('/api/get_data?fields=' + ','.join(subset))
+                self.assertEqual(response.status_code, 200)
+
+        snapshot = get_storage().snapshot()
+        views = get_view_cache(snapshot)
+        self.assertLessEqual(views.stats()['bytes'], 20000)
+        self.assertLess(views.stats()['entries'], 2 ** len(fields) - 1)
+        self.assertFalse([key for key in snapshot._derived if isinstance(key, tuple) and key[0] in ('projection', 'payload')])
+
+        # Views that were dropped are built again
+        response = self.app.get('/api/get_data?fields=name')
+        self.assertEqual(json.loads(response.data)['restaurants'][0]['name'], 'Restaurant A')
+
+    def test_search_fields_and_restaurant(self):
+        response = self.app.get('/api/get_data/search?area=items&option=name&name=Pepperoni&restaurant=Restaurant B&fields=name,id')
+        self.assertEqual(response.status_code, 200)
+        items = json.loads(response.data)
+        self.assertEqual(len(items), 1)
+        self.assertEqual(set(items[0].keys()), {'name', 'id'})
+
+        # Restaurants that do not exist find nothing, and are not remembered
+        for n in range(3):
+            response = self.app.get(f'/api/get_data/search?area=items&option=name&name=Pepperoni&restaurant=Missing {n}')
+            self.assertEqual(response.status_code, 404)
+        snapshot = get_storage().snapshot()
+        self.assertFalse([key for key in snapshot._derived if key[0] == 'scope' and key[1].startswith('Missing')])
+
+    def test_get_changes(self):
+        response = self.app.get('/api/get_data')
+        version = int(response.headers['X-Menu-Version'])
+
+        self.app.put('/api/update_data', json={
+            'path': ['restaurants', 0, 'name'],
+            'newData': 'changes test'
+        })
+        self.app.delete('/api/delete_data', json={
+            'path': ['restaurants', 1]
+        })
+
+        response = self.app.get(f'/api/get_data/changes?since={version}')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertEqual(result['version'], version + 2)
+        self.assertEqual([change['op'] for change in result['changes']], ['update', 'delete'])
+        self.assertEqual(result['changes'][0]['path'], ['restaurants', 0, 'name'])
+        self.assertEqual(result['changes'][0]['newData'], 'changes test')
+
+        response = self.app.get(f'/api/get_data/changes?since={version + 2}')
+        self.assertEqual(json.loads(response.data)['changes'], [])
+
+        # Editing the file directly means the changes are unknown
+        self.undo_changes()
+        response = self.app.get(f'/api/get_data/changes?since={version + 2}')
+        self.assertTrue(json.loads(response.data)['resync'])
+
+    def test_get_changes_journal(self):
+        app.config['MENU_STORAGE'] = 'journal'
+        version = int(self.app.get('/api/get_data').headers['X-Menu-Version'])
+
+        self.app.put('/api/update_data', json={
+            'path': ['restaurants', 0, 'name'],
+            'newData': 'changes test'
+        })
+        get_storage().compact()
+        self.app.put('/api/update_data', json={
+            'path': ['restaurants', 1, 'name'],
+            'newData': 'changes test 2'
+        })
+
+        result = json.loads(self.app.get(f'/api/get_data/changes?since={version}').data)
+        self.assertEqual(result['version'], version + 2)
+        self.assertEqual([change['path'][1] for change in result['changes']], [0, 1])
+
+    def test_journal_compaction_keeps_version(self):
+        # Two storages on the same file stand in for two workers
+        writer = menu_storage.JournaledStorage(self.test_data_path)
+        reader = menu_storage.JournaledStorage(self.test_data_path)
+        for n in range(3):
+            writer.commit([{'op': 'update', 'path': ['restaurants', 0, 'name'], 'value': f'Compacted {n}'}])
+        self.assertEqual(reader.snapshot().version, 3)
+
+        # The reader looks between the compaction writing the new base and
+        # starting the journal for it
+        base = menu_cache.store_menu(self.test_data_path, writer.snapshot().data)
+        self.assertEqual(reader.snapshot().version, 3)
+        writer._start_journal(base.signature)
+        snapshot = reader.snapshot()
+        self.assertEqual(snapshot.version, 3)
+        self.assertEqual(snapshot.data['restaurants'][0]['name'], 'Compacted 2')
+        version, changes = reader.changes_since(2)
+        self.assertEqual([change['value'] for change in changes], ['Compacted 2'])
+
+    def test_get_changes_other_worker(self):
+        # Two json storages on the same file stand in for two workers
+        first = menu_storage.JsonFileStorage(self.test_data_path)
+        second = menu_storage.JsonFileStorage(self.test_data_path)
+        start = first.snapshot().version
+        second.snapshot()
+        first.commit([{'op': 'update', 'path': ['restaurants', 0, 'name'], 'value': 'First Worker'}])
+        self.assertEqual(len(first.changes_since(start)[1]), 1)
+        second.commit([{'op': 'update', 'path': ['restaurants', 1, 'name'], 'value': 'Second Worker'}])
+
+        # The second worker cannot know what happened since the first
+        # worker's version, so the client is told to resync
+        for version in [start, start + 1]:
+            self.assertIsNone(second.changes_since(version)[1])
+
+    def test_get_changes_invalid(self):
+        response = self.app.get('/api/get_data/changes?since=abc')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, b'Invalid since parameter')
+
+    def read_event(self, events):
+        while True:
+            chunk = next(events)
+            chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+            if not chunk.startswith(':'):
+                fields = dict(line.split(': ', 1) for line in chunk.strip().split('\n'))
+                return fields['event'], json.loads(fields['data'])
+
+    def test_events(self):
+        response = self.app.get('/api/get_data/events', buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = iter(response.response)
+
+        event, data = self.read_event(events)
+        self.assertEqual(event, 'ready')
+        version = data['version']
+
+        self.app.put('/api/update_data', json={
+            'path': ['restaurants', 0, 'name'],
+            'newData': 'events test'
+        })
+
+        event, data = self.read_event(events)
+        self.assertEqual(event, 'change')
+        self.assertEqual(data['version'], version + 1)
+        self.assertEqual(data['path'], ['restaurants', 0, 'name'])
+        self.assertEqual(data['newData'], 'events test')
+
+        response.close()
+        self.undo_changes()
+
+    def test_events_slow_consumer(self):
+        app.config['MENU_STORAGE'] = 'journal'
+        app.config['MENU_EVENTS_QUEUE_SIZE'] = 1
+
+        response = self.app.get('/api/get_data/events', buffered=False)
+        events = iter(response.response)
+        self.assertEqual(self.read_event(events)[0], 'ready')
+
+        for name in ['first', 'second']:
+            self.app.put('/api/update_data', json={
+                'path': ['restaurants', 0, 'name'],
+                'newData': name
+            })
+
+        self.assertEqual(self.read_event(events)[0], 'resync')
+        with self.assertRaises(StopIteration):
+            next(events)
+        response.close()
+
     def undo_changes(self):
         if os.path.exists(self.test_data_path):
             with open(self.test_data_path, 'w') as f:
@@ -19,7 +19,7 @@ const MenuScreen = ({ navigation }) => {
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const response = await fetch("http://YOUR_DEVICE_IP_HERE/api/get_data");
+        const response = await fetch("http://YOUR_DEVICE_IP_HERE/api/get_data?fields=id,name,price,image,dietary,rewardEligible");
         const data = await response.json();
         const flattenedItems = flattenMenuItems(data.restaurants);
         setMenuItems(flattenedItems);